@@ -0,0 +1,201 @@
+"""Admin analytics: state -> facility -> pharmacy drill-down.
+
+Every number is a GROUP BY in the database, and refill counts come from the
+``refill_monthly`` rollups, so a page costs a few small aggregate queries
+whatever the size of the refill table. Names come from the refdata cache
+rather than joins.
+
+A view is cached per (level, id, window) for ``CACHE_TTL`` seconds and is
+plain JSON-able data, so the page and the JSON API share it.
+"""
+import os
+from datetime import datetime
+
+from sqlalchemy import case, func
+
+from cache import TTLCache
+from database import read_session
+from models import DRUGS, Client, Pharmacy, CurrentStock, StockForecast, RefillMonthly
+from refdata import refdata
+from rollups import months_ago
+
+# window name -> months including the current one, None for everything
+WINDOWS = {'3m': 3, '6m': 6, '12m': 12, '24m': 24, 'all': None}
+DEFAULT_WINDOW = '12m'
+# everything in the system; all facilities sit in one state
+STATE_NAME = os.getenv('STATE_NAME', 'Lagos State')
+
+CACHE_TTL = int(os.getenv('ANALYTICS_CACHE_TTL', 300))
+views = TTLCache(maxsize=2048, ttl=CACHE_TTL)
+
+
+class NotFound(Exception):
+    """No such facility or pharmacy."""
+
+
+def _since(window):
+    months = WINDOWS[window]
+    return months_ago(months - 1) if months else None
+
+
+def _iso(d):
+    return d.isoformat() if d is not None else None
+
+
+def _refill_groups(key, since, *filters):
+    """key -> (refills in the window, latest month with any refills)."""
+    M = RefillMonthly
+    in_window = M.refills if since is None else case((M.month >= since, M.refills), else_=0)
+    rows = read_session.query(key, func.sum(in_window), func.max(M.month))\
+        .filter(*filters).group_by(key)
+    return {k: (int(n or 0), m) for k, n, m in rows}
+
+
+def _monthly(since, *filters):
+    M = RefillMonthly
+    q = read_session.query(M.month, M.drug, func.sum(M.refills)).filter(*filters)
+    if since is not None:
+        q = q.filter(M.month >= since)
+    months = {}
+    for month, drug, n in q.group_by(M.month, M.drug):
+        row = months.setdefault(month, {'month': _iso(month), 'refills': dict.fromkeys(DRUGS, 0), 'total': 0})
+        row['refills'][drug] = row['refills'].get(drug, 0) + int(n)
+        row['total'] += int(n)
+    return [months[m] for m in sorted(months, reverse=True)]
+
+
+def _client_groups(key, *filters):
+    """key -> (clients, clients with a servicing pharmacy)."""
+    rows = read_session.query(key, func.count(Client.id), func.count(Client.pharmacy_id))\
+        .filter(*filters).group_by(key)
+    return {k: (n, assigned) for k, n, assigned in rows}
+
+
+def _stock_alerts(*filters):
+    F = StockForecast
+    rows = read_session.query(F.status, func.count(), func.max(F.as_of))\
+        .join(Pharmacy, Pharmacy.id==F.pharmacy_id).filter(*filters).group_by(F.status)
+    counts, as_of = {}, None
+    for status, n, day in rows:
+        counts[status] = n
+        as_of = max(as_of, day) if as_of else day
+    return {'as_of': _iso(as_of), 'counts': counts}
+
+
+def _inactive(pharmacies, refills):
+    return [{'id': p.id, 'name': p.name, 'facility_id': p.facility_id}
+            for p in pharmacies if not refills.get(p.id, (0, None))[0]]
+
+
+def _summary(clients, pharmacies, refills):
+    n, assigned = clients
+    return {'pharmacies': pharmacies, 'clients': n, 'unassigned_clients': n - assigned, 'refills': refills}
+
+
+def _state(ref, since):
+    by_facility = _refill_groups(RefillMonthly.facility_id, since)
+    by_pharmacy = _refill_groups(RefillMonthly.pharmacy_id, since)
+    clients = _client_groups(Client.facility_id)
+    pharmacy_counts = dict(read_session.query(Pharmacy.facility_id, func.count()).group_by(Pharmacy.facility_id))
+    inactive = _inactive(ref.pharmacies, by_pharmacy)
+    inactive_by_facility = {}
+    for p in inactive:
+        inactive_by_facility[p['facility_id']] = inactive_by_facility.get(p['facility_id'], 0) + 1
+
+    children = []
+    for f in ref.facilities:
+        n, last = by_facility.get(f.id, (0, None))
+        c, assigned = clients.get(f.id, (0, 0))
+        children.append({'level': 'facility', 'id': f.id, 'name': f.name, 'shortname': f.shortname,
+                         'pharmacies': pharmacy_counts.get(f.id, 0), 'clients': c, 'unassigned_clients': c - assigned,
+                         'refills': n, 'last_refill_month': _iso(last),
+                         'inactive_pharmacies': inactive_by_facility.get(f.id, 0)})
+    totals = tuple(map(sum, zip(*clients.values()))) or (0, 0)
+    return {
+        'name': STATE_NAME, 'parent': None,
+        'summary': {'facilities': len(ref.facilities),
+                    **_summary(totals, len(ref.pharmacies), sum(n for n, _ in by_facility.values()))},
+        'children': children,
+        'monthly': _monthly(since),
+        'inactive_pharmacies': inactive,
+        'stock_alerts': _stock_alerts(),
+    }
+
+
+def _facility(ref, facility_id, since):
+    facility = ref.facility_by_id.get(facility_id)
+    if facility is None:
+        raise NotFound(facility_id)
+    pharmacies = list(ref.pharmacies_for(facility_id).values())
+    # refills of this facility's clients, by the pharmacy that dispensed them
+    by_pharmacy = _refill_groups(RefillMonthly.pharmacy_id, since, RefillMonthly.facility_id==facility_id)
+    clients = _client_groups(Client.pharmacy_id, Client.facility_id==facility_id)
+
+    children = []
+    for p in pharmacies + [ref.pharmacy_by_id[pid] for pid in by_pharmacy
+                           if pid in ref.pharmacy_by_id and ref.pharmacy_by_id[pid].facility_id != facility_id]:
+        n, last = by_pharmacy.get(p.id, (0, None))
+        children.append({'level': 'pharmacy', 'id': p.id, 'name': p.name, 'facility_id': p.facility_id,
+                         'clients': clients.get(p.id, (0, 0))[0], 'refills': n, 'last_refill_month': _iso(last)})
+    n = sum(c for c, _ in clients.values())
+    return {
+        'name': facility.name, 'parent': {'level': 'state', 'id': None, 'name': STATE_NAME},
+        'summary': _summary((n, n - clients.get(None, (0, 0))[0]), len(pharmacies),
+                            sum(r for r, _ in by_pharmacy.values())),
+        'children': children,
+        'monthly': _monthly(since, RefillMonthly.facility_id==facility_id),
+        'inactive_pharmacies': _inactive(pharmacies, by_pharmacy),
+        'stock_alerts': _stock_alerts(Pharmacy.facility_id==facility_id),
+    }
+
+
+def _pharmacy(ref, pharmacy_id, since):
+    pharmacy = ref.pharmacy_by_id.get(pharmacy_id)
+    if pharmacy is None:
+        raise NotFound(pharmacy_id)
+    facility = ref.facility_by_id.get(pharmacy.facility_id)
+    by_drug = _refill_groups(RefillMonthly.drug, since, RefillMonthly.pharmacy_id==pharmacy_id)
+    clients = read_session.query(func.count(Client.id)).filter(Client.pharmacy_id==pharmacy_id).scalar()
+    stock = {drug: (q, d) for drug, q, d in read_session.query(CurrentStock.drug, CurrentStock.quantity, CurrentStock.date)
+             .filter(CurrentStock.pharmacy_id==pharmacy_id)}
+    F = StockForecast
+    forecasts = {drug: (status, days) for drug, status, days in read_session.query(F.drug, F.status, F.days_left)
+                 .filter(F.pharmacy_id==pharmacy_id)}
+
+    children = []
+    for drug in sorted(set(DRUGS) | set(by_drug)):
+        n, last = by_drug.get(drug, (0, None))
+        quantity, counted = stock.get(drug, (None, None))
+        status, days_left = forecasts.get(drug, (None, None))
+        children.append({'level': 'drug', 'id': drug, 'name': drug, 'refills': n, 'last_refill_month': _iso(last),
+                         'stock_quantity': quantity, 'stock_date': _iso(counted), 'forecast_status': status,
+                         'days_left': round(days_left, 1) if days_left is not None else None})
+    return {
+        'name': pharmacy.name,
+        'parent': {'level': 'facility', 'id': pharmacy.facility_id, 'name': facility.name if facility else None},
+        'summary': {'clients': clients, 'refills': sum(n for n, _ in by_drug.values())},
+        'children': children,
+        'monthly': _monthly(since, RefillMonthly.pharmacy_id==pharmacy_id),
+        'inactive_pharmacies': [],
+        'stock_alerts': _stock_alerts(Pharmacy.id==pharmacy_id),
+    }
+
+
+_BUILDERS = {'state': _state, 'facility': _facility, 'pharmacy': _pharmacy}
+
+
+def build(level, item_id=None, window=DEFAULT_WINDOW):
+    ref = refdata.get()
+    since = _since(window)
+    args = (ref, since) if level == 'state' else (ref, item_id, since)
+    view = _BUILDERS[level](*args)
+    view.update(level=level, id=item_id, window=window, since=_iso(since),
+                generated_at=datetime.utcnow().isoformat(timespec='seconds') + 'Z')
+    return view
+
+
+def get(level, item_id=None, window=DEFAULT_WINDOW):
+    """The cached view. Raises KeyError for a bad level/window, NotFound for a bad id."""
+    if level not in _BUILDERS or window not in WINDOWS:
+        raise KeyError((level, window))
+    return views.get_or_set((level, item_id, window), lambda: build(level, item_id, window))
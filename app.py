@@ -1,86 +1,123 @@
 import os
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash
-from dotenv import load_dotenv
-from passlib.hash import pbkdf2_sha256
-import pandas as pd
-from io import BytesIO, StringIO
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, send_file, flash, jsonify, abort, Response, stream_with_context
+from io import StringIO
 import csv
+import gzip
+import json
+from tempfile import SpooledTemporaryFile
 
+from config import get_config
 from extensions import db
-from models import User, Facility, Pharmacy, Client, Refill, Stock
-from utils import role_required
-from werkzeug.utils import secure_filename  
+import database
+import migrations
+import metrics
+import parquet_export
+import analytics
+import sync
+from models import Facility, Pharmacy, Client, Refill
+from inventory import record_stock
+from rollups import record_refills, pharmacy_refill_count
+from cache import dashboard_counts, invalidate_dashboard
+from ingest import read_refill_rows, ingest_refills
+from client_index import client_ids
+from refdata import refdata, bump_version as bump_refdata_version
+from uploads import UploadStore
+from utils import role_required, api_role_required
+from auth import authenticate, LoginLocked, LoginBusy
+from reports import REPORTS, ADMIN_CSV_COLUMNS, admin_csv_rows, report_scope, job_id, parse_job_id, store as report_store
 
-load_dotenv()
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# rows fetched per round trip when streaming exports
+CSV_BATCH_SIZE = 1000
+CLIENTS_PAGE_SIZE = 50
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///c_refill.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = os.getenv('SECRET_KEY', 'supersecretkey')
+bp = Blueprint('main', __name__)
 
-# File upload setup
-UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+def create_app(profile=None):
+    """Build the app for a config profile (development, production, testing; default APP_CONFIG)."""
+    app = Flask(__name__)
+    app.config.from_object(get_config(profile))
+    if not (app.debug or app.testing) and app.config['SECRET_KEY'] == 'supersecretkey':
+        raise RuntimeError('set SECRET_KEY before running in production')
+    app.config['REPORT_CACHE_DIR'] = app.config['REPORT_CACHE_DIR'] or os.path.join(app.instance_path, 'reports')
+    app.config['PARQUET_EXPORT_DIR'] = app.config['PARQUET_EXPORT_DIR'] or os.path.join(app.instance_path, 'exports')
+    if app.config['METRICS_DIR'] is None:
+        app.config['METRICS_DIR'] = os.path.join(app.instance_path, 'metrics')
+
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app.extensions['uploads'] = UploadStore(app.config['UPLOAD_FOLDER'])
+
+    database.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-db.init_app(app)
-
-@app.route('/')
+@bp.route('/')
 def index():
     if 'user_id' in session:
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
+        return redirect(url_for('.dashboard'))
+    return redirect(url_for('.login'))
 
-@app.route('/login', methods=['GET','POST'])
+@bp.route('/login', methods=['GET','POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username'].strip()
         password = request.form['password'].strip()
-        user = User.query.filter_by(username=username).first()
-        if user and pbkdf2_sha256.verify(password, user.password):
+        try:
+            user = authenticate(username, password)
+        except LoginLocked as e:
+            flash(f'Too many failed attempts, try again in {e.retry_after // 60 + 1} minutes', 'error')
+            return render_template('login.html'), 429
+        except LoginBusy:
+            flash('The server is busy, please try again', 'error')
+            return render_template('login.html'), 503
+        if user:
             session['user_id'] = user.id
             session['role'] = user.role
             session['facility_id'] = user.facility_id
             session['pharmacy_id'] = user.pharmacy_id
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('.dashboard'))
         flash('Invalid credentials', 'error')
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 def dashboard():
     if 'role' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     role = session['role']
     if role == 'admin':
-        fac_count = Facility.query.count()
-        pharm_count = Pharmacy.query.count()
-        client_count = Client.query.count()
-        return render_template('admin_dashboard.html', fac_count=fac_count, pharm_count=pharm_count, client_count=client_count)
+        counts = dashboard_counts.get_or_set(('admin', None), lambda: dict(
+            fac_count=Facility.query.count(),
+            pharm_count=Pharmacy.query.count(),
+            client_count=Client.query.count(),
+        ))
+        return render_template('admin_dashboard.html', **counts)
     if role == 'facility':
-        facility = Facility.query.get(session.get('facility_id'))
-        clients = Client.query.filter_by(facility_id=facility.id).count() if facility else 0
-        pharms = Pharmacy.query.filter_by(facility_id=facility.id).count() if facility else 0
-        return render_template('facility_dashboard.html', facility=facility, client_count=clients, pharm_count=pharms)
+        facility = refdata.get().facility_by_id.get(session.get('facility_id'))
+        counts = dashboard_counts.get_or_set(('facility', facility.id), lambda: dict(
+            client_count=Client.query.filter_by(facility_id=facility.id).count(),
+            pharm_count=Pharmacy.query.filter_by(facility_id=facility.id).count(),
+        )) if facility else dict(client_count=0, pharm_count=0)
+        return render_template('facility_dashboard.html', facility=facility, **counts)
     if role == 'pharmacy':
-        pharmacy = Pharmacy.query.get(session.get('pharmacy_id'))
-        refill_count = Refill.query.filter_by(pharmacy_id=pharmacy.id).count() if pharmacy else 0
+        pharmacy = refdata.get().pharmacy_by_id.get(session.get('pharmacy_id'))
+        refill_count = dashboard_counts.get_or_set(('pharmacy', pharmacy.id), lambda:
+            pharmacy_refill_count(pharmacy.id)) if pharmacy else 0
         return render_template('pharmacy_dashboard.html', pharmacy=pharmacy, refill_count=refill_count)
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 # admiun to add facility and pharmacies
-@app.route('/admin/facility/new', methods=['GET','POST'])
+@bp.route('/admin/facility/new', methods=['GET','POST'])
 @role_required('admin')
 def admin_add_facility():
     if request.method == 'POST':
@@ -88,36 +125,39 @@ def admin_add_facility():
         shortname = request.form['shortname'].strip().upper()
         if not name or not shortname:
             flash('Name and shortname required', 'error')
-            return redirect(url_for('admin_add_facility'))
+            return redirect(url_for('.admin_add_facility'))
         fac = Facility(name=name, shortname=shortname)
         db.session.add(fac)
+        bump_refdata_version()
         db.session.commit()
+        refdata.invalidate()
+        invalidate_dashboard()
         flash('Facility added', 'ok')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('.dashboard'))
     return render_template('admin_add_facility.html')
 
-@app.route('/admin/pharmacy/new', methods=['GET','POST'])
+@bp.route('/admin/pharmacy/new', methods=['GET','POST'])
 @role_required('admin')
 def admin_add_pharmacy():
-    facilities = Facility.query.order_by(Facility.name).all()
     if request.method == 'POST':
         name = request.form['name'].strip()
         facility_id = int(request.form['facility_id'])
         ph = Pharmacy(name=name, facility_id=facility_id)
         db.session.add(ph)
+        bump_refdata_version()
         db.session.commit()
+        refdata.invalidate()
+        invalidate_dashboard(facility_id=facility_id)
         flash('Pharmacy added', 'ok')
-        return redirect(url_for('dashboard'))
-    return render_template('admin_add_pharmacy.html', facilities=facilities)
+        return redirect(url_for('.dashboard'))
+    return render_template('admin_add_pharmacy.html', facilities=refdata.get().facilities)
 
 # client creation for everyone(you get to create, i get to create)
-@app.route('/clients/new', methods=['GET','POST'])
+@bp.route('/clients/new', methods=['GET','POST'])
 def add_client():
     if 'role' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     role = session['role']
-    facilities = Facility.query.order_by(Facility.name).all()
-    pharmacies = Pharmacy.query.order_by(Pharmacy.name).all()
 
     if request.method == 'POST':
         unique_id = request.form['unique_id'].strip().upper()
@@ -131,66 +171,104 @@ def add_client():
 
         if not unique_id:
             flash('Unique ID required', 'error')
-            return redirect(url_for('add_client'))
+            return redirect(url_for('.add_client'))
 
         client = Client(name=name, unique_id=unique_id, facility_id=facility_id, pharmacy_id=pharmacy_id)
         db.session.add(client)
         db.session.commit()
+        invalidate_dashboard(facility_id=facility_id)
+        if pharmacy_id:
+            client_ids.add(pharmacy_id, unique_id)
         flash('Client added', 'ok')
-        return redirect(url_for('dashboard'))
-    return render_template('client_new.html', facilities=facilities, pharmacies=pharmacies, role=role)
+        return redirect(url_for('.dashboard'))
+    # the dropdowns fill themselves from refdata_json, which the browser keeps cached
+    return render_template('client_new.html', refdata_version=refdata.get().version, role=role)
+
+@bp.route('/refdata.json')
+@role_required('admin', 'facility', 'pharmacy')
+def refdata_json():
+    data = refdata.get()
+    resp = Response(data.json(), mimetype='application/json')
+    resp.set_etag(f'refdata-{data.version}')
+    resp.cache_control.private = True
+    if request.args.get('v') == str(data.version):
+        # a new version gets a new URL, so this one never changes
+        resp.cache_control.max_age = 365 * 24 * 3600
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
 
 #facility sees clients and reports
-@app.route('/facility/clients')
+@bp.route('/facility/clients')
 @role_required('facility')
 def facility_clients():
     facility_id = session.get('facility_id')
-    clients = Client.query.filter_by(facility_id=facility_id).all()
-    pharmacies = {p.id: p for p in Pharmacy.query.filter_by(facility_id=facility_id).all()}
-    return render_template('facility_clients.html', clients=clients, pharmacies=pharmacies)
-
-@app.route('/facility/reports')
+    q = request.args.get('q', '').strip()
+    pharmacy_id = request.args.get('pharmacy_id', type=int)
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    # keyset pages on (facility_id, unique_id) so every page costs the same
+    query = db.session.query(Client.name, Client.unique_id, Client.pharmacy_id).filter(Client.facility_id==facility_id)
+    if pharmacy_id:
+        query = query.filter(Client.pharmacy_id==pharmacy_id)
+    if q:
+        # unique IDs are stored upper case, a prefix is just a range on the index
+        prefix = q.upper()
+        query = query.filter(db.or_(
+            db.and_(Client.unique_id >= prefix, Client.unique_id < prefix + '\uffff'),
+            Client.name.icontains(q, autoescape=True),
+        ))
+    if before:
+        clients = query.filter(Client.unique_id < before).order_by(Client.unique_id.desc()).limit(CLIENTS_PAGE_SIZE + 1).all()
+        has_prev = len(clients) > CLIENTS_PAGE_SIZE
+        clients = clients[:CLIENTS_PAGE_SIZE][::-1]
+        has_next = True
+    else:
+        if after:
+            query = query.filter(Client.unique_id > after)
+        clients = query.order_by(Client.unique_id).limit(CLIENTS_PAGE_SIZE + 1).all()
+        has_next = len(clients) > CLIENTS_PAGE_SIZE
+        clients = clients[:CLIENTS_PAGE_SIZE]
+        has_prev = bool(after)
+
+    pharmacies = refdata.get().pharmacies_for(facility_id)
+    return render_template('facility_clients.html', clients=clients, pharmacies=pharmacies, q=q,
+                           pharmacy_id=pharmacy_id, has_prev=has_prev, has_next=has_next)
+
+@bp.route('/facility/reports')
 @role_required('facility')
 def facility_reports():
     return render_template('facility_reports.html')
 
-@app.route('/facility/reports/refill.xlsx')
+@bp.route('/facility/reports/refill.xlsx')
 @role_required('facility')
 def facility_refill_report():
-    facility_id = session.get('facility_id')
-    # refill, pharamcy and clients
-    data = db.session.query(Client.name, Client.unique_id, Refill.drug, Refill.refill_date, Pharmacy.name.label('pharmacy_name'))\
-        .join(Refill, Refill.client_id==Client.id)\
-        .join(Pharmacy, Pharmacy.id==Refill.pharmacy_id)\
-        .filter(Client.facility_id==facility_id).all()
-    df = pd.DataFrame(data, columns=['Client Name','Unique ID','Drug','Refill Date','Pharmacy'])
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Refills')
-    buf.seek(0)
-    return send_file(buf, as_attachment=True, download_name='facility_refills.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-@app.route('/facility/reports/stock.xlsx')
+    return send_report('facility_refills')
+
+@bp.route('/facility/reports/stock.xlsx')
 @role_required('facility')
 def facility_stock_report():
-    facility_id = session.get('facility_id')
-    #stock upload kinda confused on how to do this tho i hio[pe to remember]
-    subq = db.session.query(Stock.pharmacy_id, Stock.drug, db.func.max(Stock.date).label('max_date'))\
-        .join(Pharmacy, Pharmacy.id==Stock.pharmacy_id)\
-        .filter(Pharmacy.facility_id==facility_id)\
-        .group_by(Stock.pharmacy_id, Stock.drug).subquery()
-    rows = db.session.query(Pharmacy.name, Stock.drug, Stock.quantity, Stock.date)\
-        .join(subq, (Stock.pharmacy_id==subq.c.pharmacy_id) & (Stock.drug==subq.c.drug) & (Stock.date==subq.c.max_date))\
-        .join(Pharmacy, Pharmacy.id==Stock.pharmacy_id).all()
-    df = pd.DataFrame(rows, columns=['Pharmacy','Drug','Quantity','Date'])
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Stocks')
-    buf.seek(0)
-    return send_file(buf, as_attachment=True, download_name='facility_stocks.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return send_report('facility_stock')
+
+@bp.route('/facility/reports/adherence.xlsx')
+@role_required('facility')
+def facility_adherence_report():
+    return send_report('facility_adherence')
+
+@bp.route('/facility/reports/monthly.xlsx')
+@role_required('facility')
+def facility_monthly_report():
+    return send_report('facility_monthly')
+
+@bp.route('/facility/reports/stockout.xlsx')
+@role_required('facility')
+def facility_forecast_report():
+    return send_report('facility_forecast')
 
 #pharamcy: still no names babes
-@app.route('/pharmacy/refill', methods=['GET','POST'])
+@bp.route('/pharmacy/refill', methods=['GET','POST'])
 @role_required('pharmacy')
 def pharmacy_refill():
     if request.method == 'POST':
@@ -199,145 +277,356 @@ def pharmacy_refill():
         refill_date = request.form['refill_date']
         pharmacy_id = session.get('pharmacy_id')
 
+        client = Client.query.filter_by(unique_id=unique_id).first()
+        if not client:
+            flash('Client not found', 'error')
+            return redirect(url_for('.pharmacy_refill'))
+
         # Handle file upload
         file = request.files.get('upload_file')
-        filename = None
+        upload_key = None
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            upload_key = current_app.extensions['uploads'].save(file)
         else:
             if file and file.filename != '':
                 flash("Invalid file type. Only JPG, JPEG, PNG allowed.", "error")
         # file uplod complete
 
-        client = Client.query.filter_by(unique_id=unique_id).first()
-        if not client:
-            flash('Client not found', 'error')
-            return redirect(url_for('pharmacy_refill'))
-        r = Refill(client_id=client.id, drug=drug, refill_date=datetime.fromisoformat(refill_date).date(), pharmacy_id=pharmacy_id)
+        r = Refill(client_id=client.id, drug=drug, refill_date=datetime.fromisoformat(refill_date).date(),
+                   pharmacy_id=pharmacy_id, upload_filename=upload_key)
         db.session.add(r)
+        record_refills([(client.facility_id, pharmacy_id, drug, r.refill_date)])
         db.session.commit()
+        invalidate_dashboard(pharmacy_id=pharmacy_id, admin=False)
         flash('Refill saved', 'ok')
-        return redirect(url_for('pharmacy_refill'))
+        return redirect(url_for('.pharmacy_refill'))
     return render_template('pharmacy_refill.html')
 
-@app.route('/pharmacy/stocks', methods=['GET','POST'])
+@bp.route('/refills/<int:refill_id>/upload')
+def refill_upload(refill_id):
+    if 'role' not in session:
+        return redirect(url_for('.login'))
+    r = Refill.query.get_or_404(refill_id)
+    role = session['role']
+    allowed = role == 'admin' \
+        or (role == 'pharmacy' and r.pharmacy_id == session.get('pharmacy_id')) \
+        or (role == 'facility' and r.client.facility_id == session.get('facility_id'))
+    if not allowed or not r.upload_filename:
+        abort(404)
+    path = current_app.extensions['uploads'].path(r.upload_filename)
+    if request.args.get('thumb'):
+        path = current_app.extensions['uploads'].thumb_path(r.upload_filename)
+        if not os.path.exists(path):
+            # not made yet (or no Pillow); don't let anything keep the miss
+            return Response('Thumbnail not ready', 404, headers={'Cache-Control': 'no-store'})
+    # patient data: never in shared caches, and the browser revalidates by ETag
+    resp = send_file(path, conditional=True)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+@bp.route('/pharmacy/clients/lookup')
+@role_required('pharmacy')
+def pharmacy_client_lookup():
+    # unique IDs only, and only this pharmacy's own clients
+    prefix = request.args.get('q', '').strip().upper()
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    ids = client_ids.lookup(session.get('pharmacy_id'), prefix, limit) if prefix else []
+    return jsonify(unique_ids=ids)
+
+@bp.route('/pharmacy/refill/upload', methods=['GET','POST'])
+@role_required('pharmacy')
+def pharmacy_refill_upload():
+    result = None
+    if request.method == 'POST':
+        pharmacy_id = session.get('pharmacy_id')
+        file = request.files.get('batch_file')
+        if not file or not file.filename:
+            flash('Choose a CSV or Excel file', 'error')
+            return redirect(url_for('.pharmacy_refill_upload'))
+        try:
+            rows = read_refill_rows(file)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('.pharmacy_refill_upload'))
+        result = ingest_refills(pharmacy_id, rows, skip_invalid=bool(request.form.get('skip_invalid')))
+        if result.inserted:
+            invalidate_dashboard(pharmacy_id=pharmacy_id, admin=False)
+            flash(f'{result.inserted} refills saved', 'ok')
+        elif result.errors:
+            flash('Nothing saved, fix the rows below and upload again', 'error')
+    return render_template('pharmacy_refill_upload.html', result=result)
+
+@bp.route('/pharmacy/stocks', methods=['GET','POST'])
 @role_required('pharmacy')
 def pharmacy_stocks():
     if request.method == 'POST':
         drug = request.form['drug']
         quantity = int(request.form['quantity'])
         date = request.form['date']
-        s = Stock(pharmacy_id=session.get('pharmacy_id'), drug=drug, quantity=quantity, date=datetime.fromisoformat(date).date())
-        db.session.add(s)
+        record_stock(session.get('pharmacy_id'), drug, quantity, datetime.fromisoformat(date).date())
         db.session.commit()
         flash('Stock saved', 'ok')
-        return redirect(url_for('pharmacy_stocks'))
+        return redirect(url_for('.pharmacy_stocks'))
     return render_template('pharmacy_stock.html')
 
-@app.route('/pharmacy/reports')
+# offline devices: one gzipped batch of queued refills/stock, idempotent by record key
+@bp.route('/pharmacy/sync', methods=['POST'])
+@api_role_required('pharmacy')
+def pharmacy_sync():
+    pharmacy_id = session.get('pharmacy_id')
+    try:
+        payload = sync.decode_body(request.get_data(cache=False), request.headers.get('Content-Encoding'))
+        refills, stock, clients_since = sync.read_batch(payload)
+    except sync.SyncError as e:
+        return jsonify(error=str(e)), e.status
+    result = sync.apply_batch(pharmacy_id, refills, stock)
+    if result['refills']['applied']:
+        invalidate_dashboard(pharmacy_id=pharmacy_id, admin=False)
+    if clients_since is not None:
+        result['clients'] = sync.client_delta(pharmacy_id, clients_since)
+    return _json_gzip(result)
+
+def _json_gzip(data):
+    body = json.dumps(data, separators=(',', ':')).encode()
+    resp = Response(body, mimetype='application/json')
+    if len(body) > 1024 and 'gzip' in request.accept_encodings:
+        resp.set_data(gzip.compress(body, compresslevel=6))
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.vary.add('Accept-Encoding')
+    resp.cache_control.no_store = True
+    return resp
+
+@bp.route('/pharmacy/reports')
 @role_required('pharmacy')
 def pharmacy_reports():
     return render_template('pharmacy_reports.html')
 
-@app.route('/pharmacy/reports/refill.xlsx')
+@bp.route('/pharmacy/reports/refill.xlsx')
 @role_required('pharmacy')
 def pharmacy_refill_report_download():
-    pharmacy_id = session.get('pharmacy_id')
-    rows = db.session.query(Client.unique_id, Refill.drug, Refill.refill_date)\
-        .join(Refill, Refill.client_id==Client.id)\
-        .filter(Refill.pharmacy_id==pharmacy_id).all()
-    df = pd.DataFrame(rows, columns=['Unique ID','Drug','Refill Date'])
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Refills')
-    buf.seek(0)
-    return send_file(buf, as_attachment=True, download_name='pharmacy_refills.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-@app.route('/pharmacy/reports/stock.xlsx')
+    return send_report('pharmacy_refills')
+
+@bp.route('/pharmacy/reports/stock.xlsx')
 @role_required('pharmacy')
 def pharmacy_stock_report_download():
-    pharmacy_id = session.get('pharmacy_id')
-    subq = db.session.query(Stock.drug, db.func.max(Stock.date).label('max_date')).filter(Stock.pharmacy_id==pharmacy_id).group_by(Stock.drug).subquery()
-    rows = db.session.query(Stock.drug, Stock.quantity, Stock.date)\
-        .join(subq, (Stock.drug==subq.c.drug) & (Stock.date==subq.c.max_date))\
-        .filter(Stock.pharmacy_id==pharmacy_id).all()
-    df = pd.DataFrame(rows, columns=['Drug','Quantity','Date'])
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Stocks')
-    buf.seek(0)
-    return send_file(buf, as_attachment=True, download_name='pharmacy_stocks.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return send_report('pharmacy_stock')
 
 # admin report(just added this morning by the way)
 
-@app.route('/admin/report/export/excel')
+@bp.route('/admin/report/export/excel')
 @role_required('admin')
 def export_admin_report_excel():
-    facilities = Facility.query.all()
-    pharmacies = Pharmacy.query.all()
-    clients = Client.query.all()
-
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        # Facilities
-        df_fac = pd.DataFrame([(f.id, f.name, f.shortname) for f in facilities], 
-                              columns=['ID','Name','Shortname'])
-        df_fac.to_excel(writer, index=False, sheet_name='Facilities')
-
-        # Pharmacies
-        df_pharm = pd.DataFrame([(p.id, p.name, p.facility.name if p.facility else None) for p in pharmacies], 
-                                columns=['ID','Name','Facility'])
-        df_pharm.to_excel(writer, index=False, sheet_name='Pharmacies')
-
-        # Clients
-        df_client = pd.DataFrame([(c.id, c.unique_id, c.name, 
-                                   c.facility.name if c.facility else None, 
-                                   c.pharmacy.name if c.pharmacy else None) 
-                                   for c in clients], 
-                                 columns=['ID','Unique ID','Name','Facility','Pharmacy'])
-        df_client.to_excel(writer, index=False, sheet_name='Clients')
-
-    buf.seek(0)
-    return send_file(buf, as_attachment=True, download_name='admin_report.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-
-@app.route('/admin/report/export/csv')
+    return send_report('admin_report')
+
+@bp.route('/admin/report/monthly.xlsx')
+@role_required('admin')
+def admin_monthly_report():
+    return send_report('admin_monthly')
+
+@bp.route('/admin/report/stockout.xlsx')
+@role_required('admin')
+def admin_forecast_report():
+    return send_report('admin_forecast')
+
+
+@bp.route('/admin/report/export/csv')
 @role_required('admin')
 def export_admin_report_csv():
-    facilities = Facility.query.all()
-    pharmacies = Pharmacy.query.all()
-    clients = Client.query.all()
-
-    output = StringIO()
-    writer = csv.writer(output)
-
-    # Write header
-    writer.writerow(["Type", "ID", "Name/Unique ID", "Facility", "Pharmacy"])
-
-    # Facilities
-    for f in facilities:
-        writer.writerow(["Facility", f.id, f.name, "-", "-"])
-
-    # Pharmacies
-    for p in pharmacies:
-        writer.writerow(["Pharmacy", p.id, p.name, p.facility.name if p.facility else "-", "-"])
-
-    # Clients
-    for c in clients:
-        writer.writerow([
-            "Client",
-            c.id,
-            c.unique_id,
-            c.facility.name if c.facility else "-",
-            c.pharmacy.name if c.pharmacy else "N/A"
-        ])
-
-    output.seek(0)
-    return send_file(BytesIO(output.getvalue().encode()), mimetype="text/csv", as_attachment=True, download_name="admin_report.csv")
-
-# run run run
+    rep = REPORTS['admin_csv']
+    job = job_id(rep, None, rep.version(None))
+    path = report_store.cached(rep, job)
+    if path or _not_modified(job, path):
+        return _report_file(rep, job, path)
+
+    # nothing built yet: stream it out in chunks rather than make the user wait for a file,
+    # keeping a copy in the report store so the next download is served from disk
+    def generate():
+        with report_store.open_artifact(rep, job) as artifact:
+            out = StringIO()
+            writer = csv.writer(out)
+            writer.writerow(ADMIN_CSV_COLUMNS)
+            for i, row in enumerate(admin_csv_rows(), 1):
+                writer.writerow(row)
+                if i % CSV_BATCH_SIZE == 0:
+                    chunk = out.getvalue()
+                    artifact.write(chunk.encode('utf-8'))
+                    yield chunk
+                    out.seek(0)
+                    out.truncate(0)
+            chunk = out.getvalue()
+            artifact.write(chunk.encode('utf-8'))
+            yield chunk
+
+    resp = Response(stream_with_context(generate()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=admin_report.csv"})
+    resp.set_etag(job)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+# analyst bulk export: parquet, partitioned by facility, incremental
+@bp.route('/admin/export/parquet', methods=['GET', 'POST'])
+@role_required('admin')
+def admin_parquet_export():
+    root = current_app.config['PARQUET_EXPORT_DIR']
+    if request.method == 'GET':
+        return jsonify(running=parquet_export.running(root), **parquet_export.load_state(root))
+    try:
+        started = parquet_export.submit(current_app._get_current_object(), root, full=request.form.get('full') == '1')
+    except parquet_export.ExportUnavailable as e:
+        flash(str(e), 'error')
+        return redirect(url_for('.dashboard'))
+    flash('Parquet export started' if started else 'An export is already running', 'ok' if started else 'error')
+    return redirect(url_for('.dashboard'))
+
+@bp.route('/admin/export/parquet.zip')
+@role_required('admin')
+def admin_parquet_download():
+    root = current_app.config['PARQUET_EXPORT_DIR']
+    if not os.path.exists(os.path.join(root, parquet_export.STATE_FILE)):
+        abort(404)
+    out = SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+    parquet_export.write_zip(root, out, since=request.args.get('since'))
+    out.seek(0)
+    return send_file(out, mimetype='application/zip', as_attachment=True, download_name='cparp_parquet.zip')
+
+# admin analytics: state -> facility -> pharmacy, all GROUP BYs over the rollups
+def _analytics_view(level, item_id):
+    window = request.args.get('window', analytics.DEFAULT_WINDOW)
+    try:
+        return analytics.get(level, item_id, window)
+    except (KeyError, analytics.NotFound):
+        abort(404)
+
+@bp.route('/admin/analytics', defaults={'level': 'state', 'item_id': None})
+@bp.route('/admin/analytics/<level>/<int:item_id>')
+@role_required('admin')
+def admin_analytics(level, item_id):
+    if level == 'state' and item_id is not None:
+        abort(404)
+    return render_template('admin_analytics.html', view=_analytics_view(level, item_id), windows=analytics.WINDOWS)
+
+@bp.route('/admin/analytics.json', defaults={'level': 'state', 'item_id': None})
+@bp.route('/admin/analytics/<level>/<int:item_id>.json')
+@role_required('admin')
+def admin_analytics_json(level, item_id):
+    if level == 'state' and item_id is not None:
+        abort(404)
+    resp = jsonify(_analytics_view(level, item_id))
+    resp.cache_control.private = True
+    resp.cache_control.max_age = analytics.CACHE_TTL
+    return resp
+
+@bp.route('/admin/metrics')
+def admin_metrics():
+    # admins in the browser, or a scraper holding METRICS_TOKEN
+    token = os.getenv('METRICS_TOKEN')
+    scraper = token and request.headers.get('Authorization') == f'Bearer {token}'
+    if not scraper and session.get('role') != 'admin':
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# reports: same file for everyone asking for the same data, built once
+
+def _not_modified(job, path):
+    # the job id is derived from the data version, so it doubles as the etag
+    if request.if_none_match:
+        return request.if_none_match.contains(job)
+    if request.if_modified_since and path:
+        return int(os.path.getmtime(path)) <= request.if_modified_since.timestamp()
+    return False
+
+def _report_file(rep, job, path):
+    if _not_modified(job, path):
+        resp = Response(status=304)
+        resp.set_etag(job)
+    else:
+        resp = send_file(path, as_attachment=True, download_name=rep.download_name, mimetype=rep.mimetype,
+                         etag=job, last_modified=os.path.getmtime(path), conditional=False)
+    # browsers keep the file but must revalidate, which is a 304 until the data changes
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+def send_report(name):
+    rep = REPORTS[name]
+    scope = report_scope(rep.role)
+    job = job_id(rep, scope, rep.version(scope))
+    path = report_store.cached(rep, job)
+    if path or _not_modified(job, path):
+        return _report_file(rep, job, path)
+    # a miss is built by the background pool (one build across all workers), never on this thread
+    report_store.submit(rep, scope, job)
+    return redirect(url_for('.report_job_wait', job=job), 303)
+
+def _own_job(job):
+    parsed = parse_job_id(job)
+    if 'role' not in session or not parsed:
+        abort(404)
+    rep, scope = parsed
+    if rep.role != session['role'] or scope != report_scope(rep.role):
+        abort(404)
+    return rep
+
+def _job_json(rep, job, status):
+    data = {'job_id': job, 'report': rep.name, 'status': status,
+            'status_url': url_for('.report_job_status', job=job)}
+    if status == 'done':
+        data['download_url'] = url_for('.report_job_download', job=job)
+    if status == 'failed':
+        data['error'] = report_store.error(job)
+    return data
+
+@bp.route('/reports/<name>/jobs', methods=['POST'])
+def submit_report_job(name):
+    rep = REPORTS.get(name)
+    if 'role' not in session or not rep or rep.role != session['role']:
+        abort(404)
+    scope = report_scope(rep.role)
+    job = job_id(rep, scope, rep.version(scope))
+    status = report_store.submit(rep, scope, job)
+    return jsonify(_job_json(rep, job, status)), 202
+
+@bp.route('/reports/jobs/<job>')
+def report_job_status(job):
+    rep = _own_job(job)
+    status = report_store.status(rep, job)
+    if status is None:
+        abort(404)
+    return jsonify(_job_json(rep, job, status))
+
+@bp.route('/reports/jobs/<job>/wait')
+def report_job_wait(job):
+    # the no-JS side of report_jobs.js: refreshes itself until the file is ready
+    rep = _own_job(job)
+    status = report_store.status(rep, job)
+    if status is None:
+        abort(404)
+    if status == 'done':
+        return redirect(url_for('.report_job_download', job=job))
+    page = render_template('report_wait.html', rep=rep, status=status,
+                           error=report_store.error(job) if status == 'failed' else None)
+    return Response(page, headers={'Cache-Control': 'no-store'})
+
+@bp.route('/reports/jobs/<job>/download')
+def report_job_download(job):
+    rep = _own_job(job)
+    path = report_store.cached(rep, job)
+    if not path:
+        abort(404)
+    return _report_file(rep, job, path)
+
+# run run run (dev server; production goes through wsgi.py, see gunicorn.conf.py)
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         db.create_all()
-    app.run(debug=True)
+        migrations.upgrade(db.engine)
+    import lifecycle
+    if app.config['WARM_UP']:
+        lifecycle.warm_up(app)
+    # with the reloader, only in the child that serves requests
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        lifecycle.start_scheduler(app)
+    app.run(debug=app.debug)
@@ -0,0 +1,163 @@
+"""Password hashing and login checks.
+
+pbkdf2 is CPU-bound on purpose, so verification runs on a small bounded thread
+pool (hashlib drops the GIL while it hashes) instead of on however many request
+threads happen to be logging in at once. Usernames with too many recent
+failures are turned away before any hashing is done, and hashes made with
+old parameters are upgraded on the next successful login.
+
+Failure counts live in the ``login_failure`` table, so the limit holds across
+every gunicorn worker and survives a worker being recycled.
+"""
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from passlib.hash import pbkdf2_sha256
+from sqlalchemy import case, delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from models import LoginFailure, User
+
+# passlib's default for pbkdf2_sha256; raise it as hardware gets faster
+HASH_ROUNDS = int(os.getenv('PASSWORD_HASH_ROUNDS', 29000))
+HASH_WORKERS = int(os.getenv('LOGIN_HASH_WORKERS', 4))
+# logins allowed to wait for a hashing thread before we answer "busy"
+MAX_PENDING = int(os.getenv('LOGIN_MAX_PENDING', HASH_WORKERS * 8))
+PENDING_TIMEOUT = 10
+
+MAX_FAILED_LOGINS = int(os.getenv('MAX_FAILED_LOGINS', 5))
+LOCKOUT_SECONDS = int(os.getenv('LOGIN_LOCKOUT_SECONDS', 15 * 60))
+
+
+class LoginLocked(Exception):
+    """Too many failed attempts for this username."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class LoginBusy(Exception):
+    """Every hashing slot is taken."""
+
+
+def hash_password(password):
+    return pbkdf2_sha256.using(rounds=HASH_ROUNDS).hash(password)
+
+
+def needs_rehash(stored):
+    try:
+        return pbkdf2_sha256.from_string(stored).rounds != HASH_ROUNDS
+    except ValueError:
+        return False
+
+
+class LoginThrottle:
+    """Failed attempts per username within a lockout window, counted in the database."""
+
+    _UPSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+    def __init__(self, max_failures=MAX_FAILED_LOGINS, window=LOCKOUT_SECONDS, prune_every=1000):
+        self.max_failures = max_failures
+        self.window = window
+        self.prune_every = prune_every
+        self._calls = itertools.count(1)
+
+    def check(self, username):
+        """(seconds until the username may try again or 0, recorded failures)."""
+        table = LoginFailure.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(select(table.c.failures, table.c.first_failed_at)
+                               .where(table.c.username==username)).first()
+        if row is None:
+            return 0, 0
+        if row.failures < self.max_failures:
+            return 0, row.failures
+        left = (row.first_failed_at - datetime.utcnow()).total_seconds() + self.window
+        return (int(left) + 1 if left > 0 else 0), row.failures
+
+    def failed(self, username):
+        now = datetime.utcnow()
+        table = LoginFailure.__table__
+        insert_ = self._UPSERT_DIALECTS[db.engine.dialect.name]
+        stmt = insert_(table).values(username=username, failures=1, first_failed_at=now)
+        # one statement, so concurrent failures on different workers all count
+        expired = table.c.first_failed_at < now - timedelta(seconds=self.window)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.username],
+            set_={'failures': case((expired, 1), else_=table.c.failures + 1),
+                  'first_failed_at': case((expired, now), else_=table.c.first_failed_at)},
+        )
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+            if next(self._calls) % self.prune_every == 0:
+                self._prune(conn, now)
+
+    def succeeded(self, username):
+        """Forget the failures. Only call it when check() found some, it takes the write lock."""
+        with db.engine.begin() as conn:
+            conn.execute(delete(LoginFailure.__table__).where(LoginFailure.__table__.c.username==username))
+
+    def _prune(self, conn, now):
+        conn.execute(delete(LoginFailure.__table__)
+                     .where(LoginFailure.__table__.c.first_failed_at < now - timedelta(seconds=self.window)))
+
+
+throttle = LoginThrottle()
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='login-hash')
+    return _pool
+
+
+def shutdown(wait=True):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+def _run(fn, *args):
+    if not _slots.acquire(timeout=PENDING_TIMEOUT):
+        raise LoginBusy()
+    try:
+        return _executor().submit(fn, *args).result()
+    finally:
+        _slots.release()
+
+
+def authenticate(username, password):
+    """The User if the credentials are good, otherwise None.
+
+    Raises LoginLocked when the username is locked out and LoginBusy when the
+    hashing pool is saturated.
+    """
+    retry_after, failures = throttle.check(username)
+    if retry_after:
+        raise LoginLocked(retry_after)
+
+    user = User.query.filter_by(username=username).first()
+    if not user or not _run(pbkdf2_sha256.verify, password, user.password):
+        throttle.failed(username)
+        return None
+
+    if failures:
+        throttle.succeeded(username)
+    if needs_rehash(user.password):
+        user.password = _run(hash_password, password)
+        db.session.commit()
+    return user
@@ -0,0 +1,154 @@
+"""Query plan / latency of the hot report and dashboard queries, before and after
+the index migrations, on a large seeded SQLite database.
+
+    python benchmarks/bench_indexes.py --facilities 50 --clients 2000 --refills 12
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine  # noqa: E402
+
+import migrations  # noqa: E402
+import models  # noqa: F401,E402
+from extensions import db  # noqa: E402
+
+DRUGS = ['TDF-3TC-DTG', 'ABC-3TC-DTG']
+
+INDEXES = ['ix_refill_client_id', 'ix_refill_pharmacy_id', 'ix_client_facility_unique_id',
+           'ix_client_facility_pharmacy', 'ix_client_pharmacy_id', 'ix_pharmacy_facility_id',
+           'ix_stock_pharmacy_drug_date']
+
+QUERIES = {
+    'facility refill report': (
+        'SELECT client.name, client.unique_id, refill.drug, refill.refill_date, pharmacy.name '
+        'FROM client JOIN refill ON refill.client_id = client.id '
+        'JOIN pharmacy ON pharmacy.id = refill.pharmacy_id WHERE client.facility_id = :facility_id'
+    ),
+    'pharmacy refill report': (
+        'SELECT client.unique_id, refill.drug, refill.refill_date FROM client '
+        'JOIN refill ON refill.client_id = client.id WHERE refill.pharmacy_id = :pharmacy_id'
+    ),
+    'facility stock report': (
+        'SELECT pharmacy.name, stock.drug, stock.quantity, stock.date FROM stock '
+        'JOIN (SELECT stock.pharmacy_id, stock.drug, max(stock.date) AS max_date FROM stock '
+        'JOIN pharmacy ON pharmacy.id = stock.pharmacy_id WHERE pharmacy.facility_id = :facility_id '
+        'GROUP BY stock.pharmacy_id, stock.drug) AS s '
+        'ON stock.pharmacy_id = s.pharmacy_id AND stock.drug = s.drug AND stock.date = s.max_date '
+        'JOIN pharmacy ON pharmacy.id = stock.pharmacy_id'
+    ),
+    'pharmacy stock report': (
+        'SELECT stock.drug, stock.quantity, stock.date FROM stock '
+        'JOIN (SELECT drug, max(date) AS max_date FROM stock WHERE pharmacy_id = :pharmacy_id GROUP BY drug) AS s '
+        'ON stock.drug = s.drug AND stock.date = s.max_date WHERE stock.pharmacy_id = :pharmacy_id'
+    ),
+    'facility client list page': (
+        'SELECT name, unique_id, pharmacy_id FROM client WHERE facility_id = :facility_id '
+        "AND unique_id > 'F1-0000500' ORDER BY unique_id LIMIT 51"
+    ),
+    'facility dashboard clients': 'SELECT count(*) FROM client WHERE facility_id = :facility_id',
+    'facility dashboard pharmacies': 'SELECT count(*) FROM pharmacy WHERE facility_id = :facility_id',
+    'pharmacy dashboard refills': 'SELECT count(*) FROM refill WHERE pharmacy_id = :pharmacy_id',
+}
+
+
+def seed(path, facilities, pharmacies, clients, refills, stock_days):
+    conn = sqlite3.connect(path)
+    start = date.today() - timedelta(days=max(stock_days, refills * 30))
+    conn.executemany('INSERT INTO facility (id, name, shortname) VALUES (?, ?, ?)',
+                     ((f, f'Facility {f}', f'F{f}') for f in range(1, facilities + 1)))
+    conn.executemany('INSERT INTO pharmacy (id, name, facility_id) VALUES (?, ?, ?)',
+                     ((p, f'Pharmacy {p}', (p - 1) // pharmacies + 1) for p in range(1, facilities * pharmacies + 1)))
+
+    def client_rows():
+        for c in range(1, facilities * clients + 1):
+            f = (c - 1) // clients + 1
+            yield c, f'Client {c}', f'F{f}-{c:07d}', f, (f - 1) * pharmacies + random.randint(1, pharmacies)
+    conn.executemany('INSERT INTO client (id, name, unique_id, facility_id, pharmacy_id) VALUES (?, ?, ?, ?, ?)',
+                     client_rows())
+
+    def refill_rows():
+        for c in range(1, facilities * clients + 1):
+            f = (c - 1) // clients + 1
+            p = (f - 1) * pharmacies + random.randint(1, pharmacies)
+            for n in range(refills):
+                yield c, random.choice(DRUGS), (start + timedelta(days=30 * n)).isoformat(), p
+    conn.executemany('INSERT INTO refill (client_id, drug, refill_date, pharmacy_id) VALUES (?, ?, ?, ?)',
+                     refill_rows())
+
+    def stock_rows():
+        for p in range(1, facilities * pharmacies + 1):
+            for d in range(stock_days):
+                for drug in DRUGS:
+                    yield p, drug, random.randint(0, 500), (start + timedelta(days=d)).isoformat()
+    conn.executemany('INSERT INTO stock (pharmacy_id, drug, quantity, date) VALUES (?, ?, ?, ?)', stock_rows())
+    conn.commit()
+    conn.close()
+
+
+def measure(engine, repeat):
+    from sqlalchemy import text
+
+    params = {'facility_id': 1, 'pharmacy_id': 1}
+    results = {}
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            plan = [row[-1] for row in conn.execute(text('EXPLAIN QUERY PLAN ' + sql), params)]
+            times = []
+            for _ in range(repeat):
+                t = time.perf_counter()
+                conn.execute(text(sql), params).fetchall()
+                times.append((time.perf_counter() - t) * 1000)
+            results[name] = (statistics.median(times), plan)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--facilities', type=int, default=50)
+    ap.add_argument('--pharmacies', type=int, default=10, help='pharmacies per facility')
+    ap.add_argument('--clients', type=int, default=2000, help='clients per facility')
+    ap.add_argument('--refills', type=int, default=12, help='refills per client')
+    ap.add_argument('--stock-days', type=int, default=365)
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    random.seed(1)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for name in INDEXES:
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+
+    t = time.perf_counter()
+    seed(path, args.facilities, args.pharmacies, args.clients, args.refills, args.stock_days)
+    print(f'seeded {path} in {time.perf_counter() - t:.1f}s')
+
+    before = measure(engine, args.repeat)
+    t = time.perf_counter()
+    migrations.upgrade(engine)
+    print(f'migrations applied in {time.perf_counter() - t:.1f}s\n')
+    after = measure(engine, args.repeat)
+
+    print(f"{'query':32} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name in QUERIES:
+        b, a = before[name][0], after[name][0]
+        print(f'{name:32} {b:10.2f} {a:10.2f} {b / a if a else 0:7.1f}x')
+    print()
+    for name in QUERIES:
+        print(name)
+        print('  before: ' + ' | '.join(before[name][1]))
+        print('  after:  ' + ' | '.join(after[name][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""Route latency benchmark against a large seeded database.
+
+Seeds a throwaway SQLite database with init_db's scale options, logs in as
+each role through Flask's test client and drives every route. For each one
+it reports p50/p95/p99 latency, SQL statements per request and peak Python
+memory, and writes the numbers as JSON so two commits can be compared:
+
+    python benchmarks/bench_routes.py --out before.json
+    python benchmarks/bench_routes.py --out after.json --compare before.json
+
+With --compare the exit status is 1 if any route's p95 got slower than
+--threshold times the baseline.
+"""
+import argparse
+import gzip
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--facilities', type=int, default=20)
+    ap.add_argument('--pharmacies', type=int, default=10, help='pharmacies per facility')
+    ap.add_argument('--clients', type=int, default=2000, help='clients per facility')
+    ap.add_argument('--refills', type=int, default=12, help='refills per client')
+    ap.add_argument('--stock-days', type=int, default=180)
+    ap.add_argument('--requests', type=int, default=20, help='timed requests per route')
+    ap.add_argument('--only', help='comma separated route names to run')
+    ap.add_argument('--out', help='write results to this JSON file')
+    ap.add_argument('--compare', help='baseline JSON to compare against')
+    ap.add_argument('--threshold', type=float, default=1.25, help='allowed p95 slowdown vs baseline')
+    ap.add_argument('--keep', action='store_true', help='keep the seeded database directory')
+    return ap.parse_args()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class QueryCounter:
+
+    def __init__(self, engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def build_routes(app, fac_code, client_uid):
+    """(name, role, fn(client, i) -> response, clear_report_cache) for every route."""
+    today = date.today().isoformat()
+
+    def get(url, **kw):
+        return lambda c, i: c.get(url, **kw)
+
+    def download(url):
+        # a cold report is queued: follow the wait page to the file like a browser would
+        def fn(c, i):
+            resp = c.get(url)
+            while resp.status_code in (302, 303):
+                location = resp.location
+                resp = c.get(location)
+                while resp.status_code == 200 and resp.mimetype == 'text/html':
+                    time.sleep(0.01)
+                    resp = c.get(location)
+            return resp
+        return fn
+
+    batch = 'unique_id,drug,date\n' + ''.join(f'{client_uid},TDF-3TC-DTG,{today}\n' for _ in range(100))
+
+    seq = itertools.count()
+    etags = {}
+
+    def not_modified(c, i):
+        url = '/facility/reports/refill.xlsx'
+        if url not in etags:
+            etags[url] = download(url)(c, i).headers['ETag']
+        return c.get(url, headers={'If-None-Match': etags[url]})
+
+    def clear_reports():
+        shutil.rmtree(app.config['REPORT_CACHE_DIR'], ignore_errors=True)
+
+    def sync_batch(c, i):
+        n = next(seq)
+        refills = [{'key': f'bench-{n}-{j}', 'unique_id': client_uid, 'drug': 'TDF-3TC-DTG', 'date': today}
+                   for j in range(100)]
+        body = gzip.compress(json.dumps({'refills': refills, 'clients_since': 0}).encode())
+        return c.post('/pharmacy/sync', data=body, headers={'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'},
+                      content_type='application/json')
+
+    def clear_analytics():
+        import analytics
+        analytics.views.clear()
+
+    return [
+        ('login', None, lambda c, i: c.post('/login', data={'username': fac_code.lower(), 'password': 'facility123'}), None),
+        ('dashboard (admin)', 'admin', get('/dashboard'), None),
+        ('dashboard (facility)', 'facility', get('/dashboard'), None),
+        ('dashboard (pharmacy)', 'pharmacy', get('/dashboard'), None),
+        ('add client form', 'admin', get('/clients/new'), None),
+        ('add client', 'admin', lambda c, i: c.post('/clients/new', data={
+            'unique_id': f'BENCH{next(seq):07d}', 'facility_id': '1', 'name': 'Bench Client'}), None),
+        ('facility clients', 'facility', get('/facility/clients'), None),
+        ('facility clients next page', 'facility', get(f'/facility/clients?after={fac_code}0500'), None),
+        ('facility clients search', 'facility', get(f'/facility/clients?q={fac_code}01'), None),
+        ('unique id lookup', 'pharmacy', get(f'/pharmacy/clients/lookup?q={client_uid[:-2]}'), None),
+        ('refill POST', 'pharmacy', lambda c, i: c.post('/pharmacy/refill', data={
+            'unique_id': client_uid, 'drug': 'TDF-3TC-DTG', 'refill_date': today}), None),
+        ('refill upload (100 rows)', 'pharmacy', lambda c, i: c.post('/pharmacy/refill/upload', data={
+            'batch_file': (io.BytesIO(batch.encode()), 'batch.csv')}, content_type='multipart/form-data'), None),
+        ('sync batch (100 refills)', 'pharmacy', sync_batch, None),
+        ('stock POST', 'pharmacy', lambda c, i: c.post('/pharmacy/stocks', data={
+            'drug': 'ABC-3TC-DTG', 'quantity': str(300 - i), 'date': today}), None),
+        ('facility refill.xlsx (cold)', 'facility', download('/facility/reports/refill.xlsx'), clear_reports),
+        ('facility refill.xlsx (warm)', 'facility', download('/facility/reports/refill.xlsx'), None),
+        ('facility stock.xlsx (cold)', 'facility', download('/facility/reports/stock.xlsx'), clear_reports),
+        ('facility monthly.xlsx (cold)', 'facility', download('/facility/reports/monthly.xlsx'), clear_reports),
+        ('facility adherence.xlsx (cold)', 'facility', download('/facility/reports/adherence.xlsx'), clear_reports),
+        ('facility stockout.xlsx (cold)', 'facility', download('/facility/reports/stockout.xlsx'), clear_reports),
+        ('pharmacy refill.xlsx (cold)', 'pharmacy', download('/pharmacy/reports/refill.xlsx'), clear_reports),
+        ('pharmacy stock.xlsx (cold)', 'pharmacy', download('/pharmacy/reports/stock.xlsx'), clear_reports),
+        ('admin export excel (cold)', 'admin', download('/admin/report/export/excel'), clear_reports),
+        ('admin export csv (stream)', 'admin', get('/admin/report/export/csv'), clear_reports),
+        ('admin analytics (cold)', 'admin', get('/admin/analytics'), clear_analytics),
+        ('admin analytics facility (cold)', 'admin', get('/admin/analytics/facility/1.json?window=all'), clear_analytics),
+        ('admin analytics (cached)', 'admin', get('/admin/analytics.json'), None),
+        ('report job submit', 'facility', lambda c, i: c.post('/reports/facility_refills/jobs'), None),
+        ('report 304', 'facility', not_modified, None),
+    ]
+
+
+def run_route(app, counter, make_client, fn, before, n):
+    """Latencies (ms), queries per request and peak traced memory (KiB) for one route."""
+    latencies, queries, statuses = [], [], set()
+    c = make_client()
+    fn(c, -1).close()  # warm up
+    for i in range(n):
+        if before:
+            before()
+        counter.count = 0
+        t = time.perf_counter()
+        resp = fn(c, i)
+        resp.get_data()
+        latencies.append((time.perf_counter() - t) * 1000)
+        queries.append(counter.count)
+        statuses.add(resp.status_code)
+        resp.close()
+
+    # one more request under tracemalloc, kept out of the timings
+    if before:
+        before()
+    tracemalloc.start()
+    resp = fn(c, n)
+    resp.get_data()
+    resp.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'queries': round(statistics.fmean(queries), 2),
+        'peak_kib': round(peak / 1024, 1),
+        'status': sorted(statuses),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['routes']
+    print(f"\n{'route':34} {'base p95':>9} {'p95':>9} {'ratio':>6}")
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b:
+            continue
+        ratio = r['p95_ms'] / b['p95_ms'] if b['p95_ms'] else 1.0
+        flag = '  <-- slower' if ratio > threshold else ''
+        print(f"{name:34} {b['p95_ms']:9.2f} {r['p95_ms']:9.2f} {ratio:6.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix='cparp-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['REPORT_CACHE_DIR'] = os.path.join(workdir, 'reports')
+    # production profile, but the test client talks plain http
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['SESSION_COOKIE_SECURE'] = '0'
+    os.environ['WARM_UP'] = '0'
+    os.chdir(workdir)  # uploads land here too
+
+    import init_db
+    from app import create_app
+    from extensions import db
+    from models import Client, Facility, User
+
+    app = create_app('production')
+
+    seed_args = init_db.parse_args([
+        '--reset', '--quiet', '--seed', '1',
+        '--facilities', str(args.facilities), '--pharmacies', str(args.pharmacies),
+        '--clients', str(args.clients), '--refills', str(args.refills), '--stock-days', str(args.stock_days),
+    ])
+    t = time.perf_counter()
+    with app.app_context():
+        init_db.seed(seed_args)
+        fac = Facility.query.order_by(Facility.id).first()
+        client = Client.query.filter(Client.facility_id==fac.id, Client.pharmacy_id.isnot(None))\
+            .order_by(Client.id).first()
+        fac_code, client_uid = fac.shortname, client.unique_id
+        pharmacy_user = User.query.filter_by(pharmacy_id=client.pharmacy_id).first().username
+        counter = QueryCounter(db.engines.values())  # writes and the read-only report engine
+    print(f'seeded {workdir} in {time.perf_counter() - t:.1f}s')
+
+    logins = {
+        'admin': ('admin', 'admin123'),
+        'facility': (fac_code.lower(), 'facility123'),
+        'pharmacy': (pharmacy_user, 'pharmacy123'),
+    }
+
+    def client_for(role):
+        def make():
+            c = app.test_client()
+            if role:
+                username, password = logins[role]
+                resp = c.post('/login', data={'username': username, 'password': password})
+                assert resp.status_code == 302, f'login as {username} failed'
+            return c
+        return make
+
+    only = set(args.only.split(',')) if args.only else None
+    routes = build_routes(app, fac_code, client_uid)
+    results = {}
+    print(f"\n{'route':34} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8} {'peak KiB':>9}")
+    for name, role, fn, before in routes:
+        if only and name not in only:
+            continue
+        r = run_route(app, counter, client_for(role), fn, before, args.requests)
+        results[name] = r
+        print(f"{name:34} {r['p50_ms']:8.2f} {r['p95_ms']:8.2f} {r['p99_ms']:8.2f} "
+              f"{r['queries']:8.1f} {r['peak_kib']:9.1f}  {r['status']}")
+
+    if out:
+        with open(out, 'w') as f:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'when': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                    'python': platform.python_version(),
+                    'scale': {k: getattr(args, k) for k in ('facilities', 'pharmacies', 'clients', 'refills', 'stock_days')},
+                    'requests': args.requests,
+                },
+                'routes': results,
+            }, f, indent=2)
+
+    regressions = compare(results, baseline, args.threshold) if baseline else []
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if regressions:
+        print(f"\n{len(regressions)} route(s) regressed beyond {args.threshold}x: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Cold start benchmark: import time, boot time and memory of a fresh worker.
+
+Each sample is a new Python process that imports the app, builds it with
+the production profile and warms it up the way a gunicorn worker does, then
+reports how long each step took and its resident memory. The heavy report
+stack (pandas, numpy, openpyxl, pyarrow) must not be loaded by then; it
+belongs to the first report request. The CLI import (init_db) is timed the
+same way.
+
+    python benchmarks/bench_startup.py --out before.json
+    python benchmarks/bench_startup.py --out after.json --compare before.json
+
+Exits 1 if a heavy module is loaded at boot, or with --compare if a median
+got worse than --threshold times the baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HEAVY_MODULES = ['pandas', 'numpy', 'openpyxl', 'pyarrow']
+
+# runs in a fresh interpreter per sample, prints one JSON line
+_SAMPLE = '''
+import json, os, sys, time
+sys.path.insert(0, {root!r})
+
+def rss_mib():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+t = time.perf_counter()
+if {cli!r}:
+    import init_db
+    print(json.dumps({{'cli_import_ms': (time.perf_counter() - t) * 1000}}))
+    sys.exit()
+from app import create_app
+imported = time.perf_counter()
+app = create_app('production')
+import lifecycle
+lifecycle.warm_up(app)
+booted = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - t) * 1000,
+    'boot_ms': (booted - t) * 1000,
+    'rss_mib': rss_mib(),
+    'heavy_loaded': [m for m in {heavy!r} if m in sys.modules],
+}}))
+'''
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--runs', type=int, default=7, help='fresh processes per measurement, the median is kept')
+    ap.add_argument('--out', help='write results to this JSON file')
+    ap.add_argument('--compare', help='baseline JSON to compare against')
+    ap.add_argument('--threshold', type=float, default=1.25, help='allowed slowdown/growth vs baseline')
+    return ap.parse_args()
+
+
+def sample(workdir, env, cli=False):
+    code = _SAMPLE.format(root=ROOT, cli=cli, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, capture_output=True, text=True)
+    if out.returncode:
+        sys.exit(f'sample failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def prepare(workdir):
+    """An empty, migrated database, so warm-up has tables to read."""
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'startup.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               REPORT_CACHE_DIR=os.path.join(workdir, 'reports'),
+               SECRET_KEY='bench')
+    subprocess.run([sys.executable, os.path.join(ROOT, 'migrations.py')], cwd=workdir, env=env,
+                   check=True, capture_output=True)
+    return env
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['startup']
+    print(f"\n{'metric':16} {'base':>9} {'now':>9} {'ratio':>6}")
+    regressions = []
+    for name, value in results.items():
+        b = baseline.get(name)
+        if not isinstance(value, float) or not b:
+            continue
+        ratio = value / b
+        flag = '  <-- worse' if ratio > threshold else ''
+        print(f"{name:16} {b:9.1f} {value:9.1f} {ratio:6.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='cparp-startup-')
+    try:
+        env = prepare(workdir)
+        boots = [sample(workdir, env) for _ in range(args.runs)]
+        clis = [sample(workdir, env, cli=True) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {k: round(statistics.median(s[k] for s in boots), 1) for k in ('import_ms', 'boot_ms', 'rss_mib')}
+    results['cli_import_ms'] = round(statistics.median(s['cli_import_ms'] for s in clis), 1)
+    heavy = sorted({m for s in boots for m in s['heavy_loaded']})
+    results['heavy_loaded'] = heavy
+
+    print(f"{'metric':16} {'median':>9}   ({args.runs} runs)")
+    for name in ('import_ms', 'boot_ms', 'cli_import_ms', 'rss_mib'):
+        print(f"{name:16} {results[name]:9.1f}")
+    print(f"heavy modules at boot: {', '.join(heavy) or 'none'}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'when': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                    'python': platform.python_version(),
+                    'runs': args.runs,
+                },
+                'startup': results,
+            }, f, indent=2)
+
+    failed = []
+    if heavy:
+        failed.append('heavy imports at boot: ' + ', '.join(heavy))
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            failed.append(f"regressed beyond {args.threshold}x: {', '.join(regressions)}")
+    if failed:
+        print('\n' + '\n'.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
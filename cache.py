@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ``ttl`` seconds after being set."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, fn):
+        # fn runs outside the lock; two threads missing at once both compute, last one wins
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = fn()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_MISSING = object()
+
+# dashboard counts keyed by (role, facility_id/pharmacy_id or None for admin).
+# the write paths invalidate their keys, the ttl covers writes from other workers
+dashboard_counts = TTLCache(maxsize=4096, ttl=int(os.getenv('DASHBOARD_CACHE_TTL', 60)))
+
+
+def invalidate_dashboard(facility_id=None, pharmacy_id=None, admin=True):
+    keys = []
+    if admin:
+        keys.append(('admin', None))
+    if facility_id is not None:
+        keys.append(('facility', facility_id))
+    if pharmacy_id is not None:
+        keys.append(('pharmacy', pharmacy_id))
+    dashboard_counts.invalidate(*keys)
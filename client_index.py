@@ -0,0 +1,126 @@
+"""In-memory unique-ID index behind the refill form autocomplete.
+
+Each pharmacy's assigned unique IDs are kept as a sorted list, so a prefix
+lookup is a bisect plus a short walk with no database round trip. The index
+takes new clients from ``add_client`` as they are saved, and reloads every
+``CLIENT_INDEX_RELOAD_SECONDS`` to pick up clients added by other worker
+processes.
+
+Loads never run on a request thread: ``lifecycle.warm_up`` fills the index at
+boot, and a reload (or a first load when warm-up is off) runs on one
+background thread while lookups keep using the old index. Until a first load
+finishes, lookups fall back to a small prefix query.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+
+from extensions import db
+from models import Client
+
+RELOAD_SECONDS = int(os.getenv('CLIENT_INDEX_RELOAD_SECONDS', 300))
+
+log = logging.getLogger(__name__)
+
+
+class ClientIdIndex:
+
+    def __init__(self, reload_seconds=RELOAD_SECONDS):
+        self.reload_seconds = reload_seconds
+        self._ids = {}  # pharmacy_id -> sorted unique_ids
+        self._loaded_at = None
+        self._snapshot_at = None  # when the scan behind _ids started
+        self._loading = 0
+        self._added = []  # (time, pharmacy_id, unique_id) from add() while a load runs
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()  # one load at a time
+
+    def load(self):
+        with self._lock:
+            self._loading += 1
+            started = time.monotonic()
+        try:
+            ids = {}
+            rows = db.session.query(Client.pharmacy_id, Client.unique_id)\
+                .filter(Client.pharmacy_id.isnot(None))\
+                .order_by(Client.pharmacy_id, Client.unique_id).yield_per(5000)
+            for pharmacy_id, unique_id in rows:
+                ids.setdefault(pharmacy_id, []).append(unique_id)
+        except BaseException:
+            with self._lock:
+                self._done_loading()
+            raise
+        with self._lock:
+            # a newer scan got in first, keep it
+            if self._snapshot_at is None or started > self._snapshot_at:
+                # clients saved after the scan began may be missing from its rows
+                for added_at, pharmacy_id, unique_id in self._added:
+                    if added_at >= started:
+                        _insert(ids.setdefault(pharmacy_id, []), unique_id)
+                self._ids = ids
+                self._snapshot_at = started
+                self._loaded_at = time.monotonic()
+            self._done_loading()
+
+    def _done_loading(self):
+        self._loading -= 1
+        if not self._loading:
+            self._added = []
+
+    def _reload(self, app):
+        try:
+            with app.app_context():
+                self.load()
+        except Exception:
+            log.exception('client index reload failed')
+        finally:
+            self._reload_lock.release()
+
+    def _ensure_loaded(self):
+        """True if the index can answer, starting a background load when it is missing or old."""
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at <= self.reload_seconds:
+            return True
+        # whoever gets the lock loads; everyone else keeps the current index
+        if self._reload_lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, args=(current_app._get_current_object(),),
+                             name='client-index-reload', daemon=True).start()
+        return loaded_at is not None
+
+    def _query(self, pharmacy_id, prefix, limit):
+        rows = db.session.query(Client.unique_id)\
+            .filter(Client.pharmacy_id==pharmacy_id, Client.unique_id.startswith(prefix, autoescape=True))\
+            .order_by(Client.unique_id).limit(limit)
+        return [uid for (uid,) in rows]
+
+    def add(self, pharmacy_id, unique_id):
+        with self._lock:
+            if self._loading:
+                self._added.append((time.monotonic(), pharmacy_id, unique_id))
+            if self._loaded_at is not None:
+                _insert(self._ids.setdefault(pharmacy_id, []), unique_id)
+
+    def lookup(self, pharmacy_id, prefix, limit=10):
+        if not self._ensure_loaded():
+            return self._query(pharmacy_id, prefix, limit)
+        with self._lock:
+            ids = self._ids.get(pharmacy_id, [])
+            i = bisect.bisect_left(ids, prefix)
+            out = []
+            while i < len(ids) and len(out) < limit and ids[i].startswith(prefix):
+                out.append(ids[i])
+                i += 1
+        return out
+
+
+def _insert(ids, unique_id):
+    i = bisect.bisect_left(ids, unique_id)
+    if i == len(ids) or ids[i] != unique_id:
+        ids.insert(i, unique_id)
+
+
+client_ids = ClientIdIndex()
@@ -0,0 +1,69 @@
+"""Config profiles for ``create_app``.
+
+The profile comes from ``APP_CONFIG`` (development, production or testing),
+and every value can still be set from the environment or ``.env``.
+"""
+import os
+
+from dotenv import load_dotenv
+
+# before anything reads os.environ at import time
+load_dotenv()
+
+
+class Config:
+    SECRET_KEY = os.getenv('SECRET_KEY', 'supersecretkey')
+    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///c_refill.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # report/export reads, defaults to the main database
+    READ_DATABASE_URL = os.getenv('READ_DATABASE_URL')
+
+    UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', os.path.join(os.getcwd(), 'uploads'))
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_UPLOAD_MB', 16)) * 1024 * 1024
+    # let nginx/apache send upload files when they sit in front of us
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', '') == '1'
+    # None means a folder under the instance path
+    REPORT_CACHE_DIR = os.getenv('REPORT_CACHE_DIR')
+    PARQUET_EXPORT_DIR = os.getenv('PARQUET_EXPORT_DIR')
+    # where workers leave metrics snapshots for /admin/metrics to add up; '' keeps them per process
+    METRICS_DIR = os.getenv('METRICS_DIR')
+
+    # prime caches and connections when the server boots
+    WARM_UP = os.getenv('WARM_UP', '1') == '1'
+    # one worker recomputes the stock-out forecasts this often, 0 leaves it to cron
+    FORECAST_REFRESH_MINUTES = int(os.getenv('FORECAST_REFRESH_MINUTES', 60))
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    WARM_UP = os.getenv('WARM_UP', '0') == '1'
+
+
+class ProductionConfig(Config):
+    DEBUG = False
+    SESSION_COOKIE_HTTPONLY = True
+    SESSION_COOKIE_SAMESITE = 'Lax'
+    SESSION_COOKIE_SECURE = os.getenv('SESSION_COOKIE_SECURE', '1') == '1'
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL', 'sqlite://')
+    WARM_UP = False
+    FORECAST_REFRESH_MINUTES = 0
+    METRICS_DIR = ''
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+}
+
+
+def get_config(profile=None):
+    profile = profile or os.getenv('APP_CONFIG', 'development')
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"unknown APP_CONFIG {profile!r}, expected one of {', '.join(PROFILES)}") from None
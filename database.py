@@ -0,0 +1,103 @@
+"""Engine setup: connection pooling, SQLite pragmas and a read-only session.
+
+``init_app`` configures the write engine behind ``db.session`` and a second
+``reports`` engine on the same database for long reads. On SQLite every
+connection gets WAL journaling (readers and the writer no longer block each
+other), a busy timeout so concurrent writers queue instead of failing with
+``database is locked``, and mmap/page cache sizing.
+
+Report and export queries go through ``read_session``. Its connections are
+``PRAGMA query_only`` and read a WAL snapshot, so a month-end export never
+holds a lock that a pharmacy's refill POST has to wait on. Set
+``READ_DATABASE_URL`` to send them to a replica instead.
+"""
+import os
+
+from flask.globals import app_ctx
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+from extensions import db
+
+READ_BIND = 'reports'
+
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 15000))
+CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+MMAP_SIZE_MB = int(os.getenv('SQLITE_MMAP_SIZE_MB', 256))
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', 4))
+
+
+def _is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def _in_memory(uri):
+    return _is_sqlite(uri) and make_url(uri).database in (None, '', ':memory:')
+
+
+def engine_options(uri, pool_size, max_overflow):
+    if _in_memory(uri):
+        return {}  # one shared connection, nothing to pool
+    options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': 30}
+    if _is_sqlite(uri):
+        # sqlite3's own busy handler; the pragma below says the same thing
+        options['connect_args'] = {'timeout': BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False}
+    else:
+        options.update(pool_pre_ping=True, pool_recycle=1800)
+    return options
+
+
+def _sqlite_pragmas(read_only):
+    def on_connect(dbapi_conn, _):
+        cur = dbapi_conn.cursor()
+        if not read_only:
+            # persistent in the file, but cheap to assert on every connect
+            cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute('PRAGMA synchronous=NORMAL')  # safe with WAL, fsyncs at checkpoints only
+        cur.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        cur.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        cur.execute(f'PRAGMA mmap_size={MMAP_SIZE_MB * 1024 * 1024}')
+        cur.execute('PRAGMA temp_store=MEMORY')
+        if read_only:
+            cur.execute('PRAGMA query_only=ON')
+        cur.close()
+    return on_connect
+
+
+class _ReadSession(Session):
+
+    def get_bind(self, *args, **kwargs):
+        return db.engines.get(READ_BIND) or db.engine
+
+
+def _app_ctx_id():
+    return id(app_ctx._get_current_object())
+
+
+# scoped like db.session: one per app context, removed when it ends
+read_session = scoped_session(sessionmaker(class_=_ReadSession), scopefunc=_app_ctx_id)
+
+
+def init_app(app):
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(uri, POOL_SIZE, MAX_OVERFLOW))
+
+    read_uri = app.config.get('READ_DATABASE_URL') or uri
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    if not _in_memory(read_uri):
+        # a second connection to :memory: would be a different, empty database
+        binds.setdefault(READ_BIND, {'url': read_uri, **engine_options(read_uri, READ_POOL_SIZE, READ_POOL_SIZE)})
+
+    db.init_app(app)
+
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', _sqlite_pragmas(read_only=key == READ_BIND))
+
+    @app.teardown_appcontext
+    def _remove_read_session(exc):
+        read_session.remove()
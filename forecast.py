@@ -0,0 +1,122 @@
+"""Stock-out forecasting from dispensing velocity.
+
+For every pharmacy and drug, refills over the last 7, 28 and 90 days give
+rolling dispensing rates. Refills made after the last stock count are taken
+off that count to estimate what is on hand today, and on hand over the daily
+rate is the days left before the shelf is empty.
+
+Results live in ``stock_forecast`` and are recomputed for every pharmacy in
+one batch, on a schedule: ``python forecast.py`` from cron, or every
+``FORECAST_REFRESH_MINUTES`` by one worker of the app (see lifecycle.py).
+Requests only read the table. A recompute that comes out the same leaves the
+table, and so ``computed_at`` and the report ETags, alone.
+"""
+import os
+from datetime import datetime, date, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, func, insert, select
+
+from extensions import db
+from models import DRUGS, CurrentStock, Pharmacy, Refill, StockForecast
+
+WINDOWS = (7, 28, 90)
+# refills don't record a quantity; stock counts are in the same packs a refill hands out
+UNITS_PER_REFILL = float(os.getenv('FORECAST_UNITS_PER_REFILL', 1))
+LEAD_TIME_DAYS = int(os.getenv('RESUPPLY_LEAD_TIME_DAYS', 14))
+LOW_STOCK_DAYS = int(os.getenv('LOW_STOCK_DAYS', 30))
+
+STOCKED_OUT, CRITICAL, LOW, OK = 'stocked out', 'critical', 'low', 'ok'
+NOT_DISPENSING, NO_COUNT = 'not dispensing', 'no stock count'
+
+
+def dispensing_rates(conn, pairs, as_of):
+    """Units per day over each window in WINDOWS, one row per (pharmacy_id, drug) pair."""
+    horizon = max(WINDOWS)
+    rows = conn.execute(
+        select(Refill.pharmacy_id, Refill.drug, Refill.refill_date, func.count())
+        .where(Refill.refill_date > as_of - timedelta(days=horizon), Refill.refill_date <= as_of)
+        .group_by(Refill.pharmacy_id, Refill.drug, Refill.refill_date)
+    ).all()
+
+    # pairs x days-ago matrix of refill counts, then a cumulative sum reads off every window
+    daily = np.zeros((len(pairs), horizon))
+    if rows:
+        counts = pd.DataFrame(rows, columns=['pharmacy_id', 'drug', 'day', 'n'])
+        row = pairs.get_indexer(pd.MultiIndex.from_frame(counts[['pharmacy_id', 'drug']]))
+        ago = np.array([(as_of - day).days for day in counts['day']])
+        keep = row >= 0  # drugs outside DRUGS
+        np.add.at(daily, (row[keep], ago[keep]), counts['n'].to_numpy()[keep])
+    totals = daily.cumsum(axis=1) * UNITS_PER_REFILL
+    return pd.DataFrame({f'rate_{w}': totals[:, w - 1] / w for w in WINDOWS}, index=pairs)
+
+
+def compute_forecasts(conn, as_of):
+    """Forecast rows for every pharmacy and drug as of a date, as a DataFrame."""
+    pharmacy_ids = conn.execute(select(Pharmacy.id).order_by(Pharmacy.id)).scalars().all()
+    pairs = pd.MultiIndex.from_product([pharmacy_ids, DRUGS], names=['pharmacy_id', 'drug'])
+    df = dispensing_rates(conn, pairs, as_of)
+
+    stock = pd.DataFrame(conn.execute(
+        select(CurrentStock.pharmacy_id, CurrentStock.drug, CurrentStock.quantity, CurrentStock.date)
+    ).all(), columns=['pharmacy_id', 'drug', 'stock_quantity', 'stock_date'])
+    # refills since each pharmacy's last count come off that count
+    since = pd.DataFrame(conn.execute(
+        select(CurrentStock.pharmacy_id, CurrentStock.drug, func.count(Refill.id))
+        .join(Refill, (Refill.pharmacy_id==CurrentStock.pharmacy_id) & (Refill.drug==CurrentStock.drug)
+              & (Refill.refill_date > CurrentStock.date) & (Refill.refill_date <= as_of))
+        .group_by(CurrentStock.pharmacy_id, CurrentStock.drug)
+    ).all(), columns=['pharmacy_id', 'drug', 'dispensed_since'])
+    df = df.join(stock.set_index(['pharmacy_id', 'drug'])).join(since.set_index(['pharmacy_id', 'drug']))
+    df['stock_quantity'] = pd.to_numeric(df['stock_quantity'])
+    df['dispensed_since'] = pd.to_numeric(df['dispensed_since']).fillna(0).astype(np.int64)
+
+    # the busier of the last week and the last four weeks, so a surge isn't averaged away
+    df['daily_rate'] = df[['rate_7', 'rate_28']].max(axis=1)
+    df['on_hand'] = (df['stock_quantity'] - df['dispensed_since'] * UNITS_PER_REFILL).clip(lower=0).round()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['days_left'] = np.where(df['daily_rate'] > 0, df['on_hand'] / df['daily_rate'], np.nan)
+
+    counted, dispensing = df['stock_quantity'].notna(), df['daily_rate'] > 0
+    df['status'] = np.select(
+        [~counted, df['on_hand'] <= 0, ~dispensing, df['days_left'] < LEAD_TIME_DAYS, df['days_left'] < LOW_STOCK_DAYS],
+        [NO_COUNT, STOCKED_OUT, NOT_DISPENSING, CRITICAL, LOW],
+        OK,
+    )
+    df['stockout_date'] = [as_of + timedelta(days=int(d)) if d == d else None for d in df['days_left']]
+    df['as_of'] = as_of
+    for col in ('stock_quantity', 'on_hand'):
+        df[col] = df[col].astype('Int64')
+    return df.reset_index()
+
+
+def refresh_forecasts(as_of=None):
+    """Recompute stock_forecast for every pharmacy in one transaction.
+
+    Returns (rows, changed); nothing is written when the forecasts came out the same.
+    """
+    as_of = as_of or date.today()
+    table = StockForecast.__table__
+    cols = [c.name for c in table.columns if c.name != 'computed_at']
+    with db.engine.begin() as conn:
+        df = compute_forecasts(conn, as_of)
+        df = df.astype(object).where(df.notna(), None)
+        rows = sorted(df[cols].itertuples(index=False, name=None), key=lambda r: (r[0], r[1]))
+        current = conn.execute(select(*(table.c[c] for c in cols)).order_by(table.c[cols[0]], table.c[cols[1]])).all()
+        if rows == [tuple(r) for r in current]:
+            return len(rows), False
+        now = datetime.utcnow()
+        conn.execute(delete(table))
+        if rows:
+            conn.execute(insert(table), [dict(zip(cols, r), computed_at=now) for r in rows])
+    return len(rows), True
+
+
+if __name__ == '__main__':
+    from app import create_app
+    app = create_app()
+
+    with app.app_context():
+        n, changed = refresh_forecasts()
+        print(f"✅ stock_forecast {'refreshed' if changed else 'unchanged'}: {n} pharmacy/drug rows")
@@ -0,0 +1,56 @@
+"""gunicorn settings for C-PARP.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Forks ``WEB_CONCURRENCY`` worker processes with ``GUNICORN_THREADS`` threads
+each. The app is loaded and warmed up once in the master, then forked, so
+workers start with open caches and no shared connections. On SIGTERM,
+workers stop taking requests and get ``GUNICORN_GRACEFUL_TIMEOUT`` seconds
+to finish what they have, including queued report builds.
+"""
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 2))
+worker_class = 'gthread'
+# keep threads at or below DB_POOL_SIZE + DB_MAX_OVERFLOW
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+# report downloads build inline on a cache miss
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# recycle workers now and then, pandas reports leave a big heap behind
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+
+
+def _app():
+    from wsgi import app  # already imported when preloading
+    return app
+
+
+def when_ready(server):
+    # master, before the first fork
+    if preload_app and _app().config['WARM_UP']:
+        import lifecycle
+        lifecycle.warm_up(_app(), keep_connections=False)
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import lifecycle
+        lifecycle.after_fork(_app())
+
+
+def post_worker_init(worker):
+    import lifecycle
+    if not preload_app and _app().config['WARM_UP']:
+        lifecycle.warm_up(_app())
+    lifecycle.start_scheduler(_app())
+
+
+def worker_exit(server, worker):
+    import lifecycle
+    lifecycle.shutdown(_app())
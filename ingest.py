@@ -0,0 +1,182 @@
+"""Batch refill uploads.
+
+Pharmacies upload a CSV or XLSX with ``unique_id``, ``drug`` and ``date``
+columns. Unique IDs are resolved with a handful of IN queries, every row is
+validated up front, and the good rows go in with one executemany inside a
+single transaction.
+"""
+import csv
+import io
+import zipfile
+from collections import namedtuple
+from datetime import date, datetime
+
+from extensions import db
+from models import DRUGS, Client, Refill
+from rollups import record_refills
+
+MAX_ROWS = 50000
+# stay well under sqlite's bound parameter limit
+LOOKUP_CHUNK = 500
+INSERT_CHUNK = 1000
+
+HEADER_ALIASES = {
+    'unique_id': 'unique_id', 'unique id': 'unique_id', 'client unique id': 'unique_id', 'client id': 'unique_id',
+    'drug': 'drug', 'regimen': 'drug',
+    'date': 'date', 'refill_date': 'date', 'refill date': 'date',
+}
+
+IngestResult = namedtuple('IngestResult', 'total inserted errors')
+RowError = namedtuple('RowError', 'line unique_id message')
+
+
+def _normalize_header(header):
+    cols = [HEADER_ALIASES.get(str(h or '').strip().lower()) for h in header]
+    missing = {'unique_id', 'drug', 'date'} - set(cols)
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(sorted(missing))}")
+    return cols
+
+
+def _csv_rows(stream):
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    try:
+        header = next(reader, None)
+        if header is None:
+            raise ValueError('The file is empty')
+        cols = _normalize_header(header)
+        for line, values in enumerate(reader, 2):
+            yield line, dict(zip(cols, values))
+    except UnicodeDecodeError:
+        # excel's plain "CSV" is usually windows-1252
+        raise ValueError('The file is not UTF-8 text. In Excel, save it as "CSV UTF-8 (Comma delimited)"') from None
+
+
+def _xlsx_rows(stream):
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    try:
+        wb = load_workbook(stream, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError):
+        raise ValueError('Not a valid .xlsx file') from None
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError('The file is empty')
+        cols = _normalize_header(header)
+        for line, values in enumerate(rows, 2):
+            yield line, dict(zip(cols, values))
+    finally:
+        wb.close()
+
+
+def read_refill_rows(file):
+    """(line number, {unique_id, drug, date}) for each non-blank row. Raises ValueError on a bad file."""
+    ext = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
+    if ext == 'csv':
+        rows = _csv_rows(file.stream)
+    elif ext == 'xlsx':
+        rows = _xlsx_rows(file.stream)
+    else:
+        raise ValueError('Only .csv and .xlsx files are accepted')
+    out = []
+    for line, row in rows:
+        if not any(v not in (None, '') for v in row.values()):
+            continue
+        out.append((line, row))
+        if len(out) > MAX_ROWS:
+            raise ValueError(f'Too many rows, the limit is {MAX_ROWS} per file')
+    return out
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.fromisoformat(str(value).strip()).date()
+
+
+def validate_refill(row):
+    """(unique_id, drug, refill_date, error message or None) for one upload/sync row."""
+    unique_id = str(row.get('unique_id') or '').strip().upper()
+    drug = str(row.get('drug') or '').strip().upper()
+    if not unique_id:
+        return unique_id, drug, None, 'Unique ID is empty'
+    if drug not in DRUGS:
+        return unique_id, drug, None, f"Unknown drug '{row.get('drug')}'"
+    try:
+        refill_date = _parse_date(row.get('date'))
+    except (TypeError, ValueError):
+        return unique_id, drug, None, f"Bad date '{row.get('date')}', use YYYY-MM-DD"
+    return unique_id, drug, refill_date, None
+
+
+def validate_stock(row):
+    """(drug, quantity, date, error message or None) for one stock count from a sync."""
+    drug = str(row.get('drug') or '').strip().upper()
+    if drug not in DRUGS:
+        return drug, None, None, f"Unknown drug '{row.get('drug')}'"
+    quantity = row.get('quantity')
+    if isinstance(quantity, bool) or not isinstance(quantity, (int, str)) or not str(quantity).strip().isdigit():
+        return drug, None, None, f"Bad quantity '{quantity}', use a whole number"
+    try:
+        day = _parse_date(row.get('date'))
+    except (TypeError, ValueError):
+        return drug, None, None, f"Bad date '{row.get('date')}', use YYYY-MM-DD"
+    return drug, int(quantity), day, None
+
+
+def resolve_clients(unique_ids):
+    """unique_id -> (client id, facility id), for the ones that exist."""
+    unique_ids = list(set(unique_ids))
+    found = {}
+    for i in range(0, len(unique_ids), LOOKUP_CHUNK):
+        chunk = unique_ids[i:i + LOOKUP_CHUNK]
+        found.update((uid, (cid, fid)) for uid, cid, fid in db.session.query(Client.unique_id, Client.id, Client.facility_id)
+                     .filter(Client.unique_id.in_(chunk)))
+    return found
+
+
+def insert_refills(values):
+    for i in range(0, len(values), INSERT_CHUNK):
+        db.session.execute(db.insert(Refill), values[i:i + INSERT_CHUNK])
+
+
+def ingest_refills(pharmacy_id, rows, skip_invalid=False):
+    """Validate and insert uploaded rows in one transaction.
+
+    Nothing is saved if any row is bad, unless ``skip_invalid`` is set, in which
+    case the good rows are saved and the bad ones reported.
+    """
+    parsed, errors = [], []
+    for line, row in rows:
+        unique_id, drug, refill_date, error = validate_refill(row)
+        if error:
+            errors.append(RowError(line, unique_id, error))
+        else:
+            parsed.append((line, unique_id, drug, refill_date))
+
+    clients = resolve_clients(uid for _, uid, _, _ in parsed)
+    values, rollup = [], []
+    for line, unique_id, drug, refill_date in parsed:
+        if unique_id not in clients:
+            errors.append(RowError(line, unique_id, 'Client not found'))
+            continue
+        client_id, facility_id = clients[unique_id]
+        values.append({'client_id': client_id, 'drug': drug, 'refill_date': refill_date, 'pharmacy_id': pharmacy_id})
+        rollup.append((facility_id, pharmacy_id, drug, refill_date))
+    errors.sort()
+
+    if errors and not skip_invalid:
+        return IngestResult(len(rows), 0, errors)
+    try:
+        insert_refills(values)
+        record_refills(rollup)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return IngestResult(len(rows), len(values), errors)
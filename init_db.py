@@ -1,11 +1,33 @@
-import sys, random
-from passlib.hash import pbkdf2_sha256
-from datetime import date
+"""Seed the database.
 
+    python init_db.py            # the Lagos facility list, 10 pharmacies and 50 clients each
+    python init_db.py --reset    # drop and recreate all tables first
 
-from app import app
+Load-testing volumes come from the scale options, e.g.
+
+    python init_db.py --reset --facilities 200 --clients 2000 --refills 24 --stock-days 365
+
+Passwords are hashed in a process pool and rows go in with bulk core inserts,
+so multi-million row refill/stock tables take minutes, not hours.
+"""
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+from app import create_app
+from auth import hash_password
 from extensions import db
-from models import User, Facility, Pharmacy, Client
+import migrations
+from inventory import rebuild_current_stock
+from rollups import rebuild_rollups
+from refdata import bump_version as bump_refdata_version
+from models import DRUGS, User, Facility, Pharmacy, Client, Refill, Stock
+
+# rows per executemany
+CHUNK = 10000
 
 
 FACILITIES = [
@@ -74,24 +96,16 @@ def base_code(name: str) -> str:
         code += p[0].upper()
     return (code or "FAC")[:4]
 
-def unique_code(proposed: str) -> str:
-    """Ensure shortname uniqueness in DB by adding 2,3,4… if needed."""
-    # track
-    if not hasattr(unique_code, "_used"):
-        unique_code._used = set()
-
+def unique_code(proposed: str, used: set) -> str:
+    """Ensure shortname uniqueness by adding 2,3,4… if needed."""
     code = proposed
     n = 2
-    def exists(c):
-        return (c in unique_code._used) or (Facility.query.filter_by(shortname=c).first() is not None)
-
-    while exists(code):
+    while code in used:
         # suffix and keep it short
         stem = proposed[: max(1, 10 - len(str(n)))]
         code = f"{stem}{n}"
         n += 1
-
-    unique_code._used.add(code)
+    used.add(code)
     return code
 
 PHARMACY_NAMES = [
@@ -105,89 +119,171 @@ FIRST_NAMES = ["Adeola","Chinedu","Funke","Ifeanyi","Ngozi","Bamidele","Yusuf","
 LAST_NAMES  = ["Adewale","Okeke","Balogun","Eze","Mohammed","Adeniyi","Ogunleye","Okafor","Abdullahi",
                "Ojo","Ogunyemi","Oladipo","Ogunbiyi","Okon","Okonjo","Ibrahim","Idowu"]
 
-def ensure_admin():
-    if not User.query.filter_by(username="admin").first():
-        db.session.add(User(username="admin", password=pbkdf2_sha256.hash("admin123"), role="admin"))
-
-def create_facility_with_logins(name: str):
-    base = base_code(name)
-    code = unique_code(base)
-    fac = Facility(name=name, shortname=code)
-    db.session.add(fac)
-    db.session.flush()  # get fac.id
-
-    # facility login (username is shortname in lowercase)
-    uname = code.lower()
-    if not User.query.filter_by(username=uname).first():
-        db.session.add(User(
-            username=uname,
-            password=pbkdf2_sha256.hash("facility123"),
-            role="facility",
-            facility_id=fac.id
-        ))
-    return fac, code
-
-def create_pharmacies_for_facility(facility, code):
-    pharms = []
-    for i in range(1, 11):  # 10 placeholders
-        pname = f"{random.choice(PHARMACY_NAMES)} {i}"
-        pharm = Pharmacy(name=pname, facility_id=facility.id)
-        db.session.add(pharm)
-        db.session.flush()
-        pharms.append(pharm)
-
-        # pharmacy login
-        p_uname = f"pharmacy{i}_{code.lower()}"
-        if not User.query.filter_by(username=p_uname).first():
-            db.session.add(User(
-                username=p_uname,
-                password=pbkdf2_sha256.hash("pharmacy123"),
-                role="pharmacy",
-                pharmacy_id=pharm.id
+def facility_names(count):
+    names = FACILITIES[:count]
+    names += [f"Synthetic Facility {n}" for n in range(len(names) + 1, count + 1)]
+    return names
+
+def hash_passwords(passwords, workers):
+    # pbkdf2 is the slow part of seeding, so spread it over every core
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(hash_password, passwords, chunksize=8))
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def bulk_insert(model, rows):
+    # rows can be a generator, it is consumed CHUNK at a time
+    total = 0
+    batch = []
+    conn = db.session.connection()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= CHUNK:
+            conn.execute(db.insert(model), batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        conn.execute(db.insert(model), batch)
+        total += len(batch)
+    return total
+
+def seed_structure(args):
+    """Facilities, pharmacies, clients and their logins. Returns (mapping, clients, pharmacies_by_facility)."""
+    used_codes = {code for (code,) in db.session.query(Facility.shortname)}
+    usernames = {name for (name,) in db.session.query(User.username)}
+
+    fac_id, pharm_id, client_id = next_id(Facility), next_id(Pharmacy), next_id(Client)
+    facilities, pharmacies, clients, logins = [], [], [], []
+    mapping = []
+    pharmacies_by_facility = {}
+    width = max(4, len(str(args.clients)))
+
+    if "admin" not in usernames:
+        logins.append(dict(username="admin", role="admin", password="admin123"))
+
+    for name in facility_names(args.facilities):
+        code = unique_code(base_code(name), used_codes)
+        facilities.append(dict(id=fac_id, name=name, shortname=code))
+        mapping.append((name, code))
+
+        # facility login (username is shortname in lowercase)
+        if code.lower() not in usernames:
+            logins.append(dict(username=code.lower(), role="facility", facility_id=fac_id, password="facility123"))
+
+        pharm_ids = []
+        for i in range(1, args.pharmacies + 1):
+            pharmacies.append(dict(id=pharm_id, name=f"{random.choice(PHARMACY_NAMES)} {i}", facility_id=fac_id))
+            p_uname = f"pharmacy{i}_{code.lower()}"
+            if p_uname not in usernames:
+                logins.append(dict(username=p_uname, role="pharmacy", pharmacy_id=pharm_id, password="pharmacy123"))
+            pharm_ids.append(pharm_id)
+            pharm_id += 1
+        pharmacies_by_facility[fac_id] = pharm_ids
+
+        for j in range(1, args.clients + 1):
+            clients.append(dict(
+                id=client_id,
+                name=f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}",
+                unique_id=f"{code}{j:0{width}d}",
+                facility_id=fac_id,
+                pharmacy_id=random.choice(pharm_ids) if pharm_ids else None,
             ))
-    return pharms
-
-def create_clients_for_facility(facility, code, pharms):
-    for j in range(1, 51):  # 50 clients
-        full_name = f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}"
-        uid = f"{code}{j:04d}"
-        assign = random.choice(pharms) if pharms else None
-        db.session.add(Client(
-            name=full_name,
-            unique_id=uid,
-            facility_id=facility.id,
-            pharmacy_id = assign.id if assign else None
-        ))
+            client_id += 1
+        fac_id += 1
 
-#run the code cause we can
-with app.app_context():
-    if "--reset" in sys.argv:
-        db.drop_all()
-        db.create_all()
-    else:
-        db.create_all()
+    hashes = hash_passwords([u.pop("password") for u in logins], args.workers)
+    for u, h in zip(logins, hashes):
+        u["password"] = h
+        u.setdefault("facility_id", None)
+        u.setdefault("pharmacy_id", None)
 
-    ensure_admin()
+    bulk_insert(Facility, facilities)
+    bulk_insert(Pharmacy, pharmacies)
+    bulk_insert(User, logins)
+    bulk_insert(Client, clients)
+    return mapping, clients, pharmacies_by_facility
 
-    mapping = []  # keep (name, code) to print summary
+def refill_rows(clients, pharmacies_by_facility, per_client):
+    today = date.today()
+    for c in clients:
+        pharm_ids = pharmacies_by_facility[c["facility_id"]]
+        if not pharm_ids:
+            continue
+        pharmacy_id = c["pharmacy_id"] or random.choice(pharm_ids)
+        drug = random.choice(DRUGS)
+        # roughly monthly, walking back from today with a few days of jitter
+        day = today - timedelta(days=random.randint(0, 40))
+        for _ in range(per_client):
+            yield dict(client_id=c["id"], drug=drug, refill_date=day, pharmacy_id=pharmacy_id)
+            day -= timedelta(days=random.randint(25, 35))
 
-    for fac_name in FACILITIES:
-        # create facility with em logins with guaranteed-unique shortname
-        fac, code = create_facility_with_logins(fac_name)
-        mapping.append((fac_name, code))
+def stock_rows(pharmacies_by_facility, days):
+    start = date.today() - timedelta(days=days - 1)
+    for pharm_ids in pharmacies_by_facility.values():
+        for pharmacy_id in pharm_ids:
+            for drug in DRUGS:
+                qty = random.randint(200, 600)
+                for d in range(days):
+                    # dispense a little every day, restock when running low
+                    qty = qty - random.randint(0, 15) if qty > 40 else qty + random.randint(300, 500)
+                    yield dict(pharmacy_id=pharmacy_id, drug=drug, quantity=qty, date=start + timedelta(days=d))
 
-        # 10 pharmacies + logins
-        pharms = create_pharmacies_for_facility(fac, code)
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Seed the C-PARP database.")
+    ap.add_argument("--reset", action="store_true", help="drop and recreate all tables first")
+    ap.add_argument("--facilities", type=int, default=len(FACILITIES), help="number of facilities")
+    ap.add_argument("--pharmacies", type=int, default=10, help="pharmacies per facility")
+    ap.add_argument("--clients", type=int, default=50, help="clients per facility")
+    ap.add_argument("--refills", type=int, default=0, help="refills per client")
+    ap.add_argument("--stock-days", type=int, default=0, help="days of daily stock history per pharmacy and drug")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used for password hashing")
+    ap.add_argument("--seed", type=int, default=None, help="random seed, for repeatable datasets")
+    ap.add_argument("--quiet", action="store_true", help="skip the facility login listing")
+    return ap.parse_args(argv)
 
-        # 50 clients with IDs derived from the code
-        create_clients_for_facility(fac, code, pharms)
+def seed(args):
+    """Create the schema and seed it. Needs an app context."""
+    random.seed(args.seed)
+    if args.reset:
+        db.drop_all()
+    db.create_all()
+    migrations.upgrade(db.engine)
+
+    t = time.perf_counter()
+    mapping, clients, pharmacies_by_facility = seed_structure(args)
+    bump_refdata_version()  # running workers reload their dropdowns
+    print(f"facilities/pharmacies/clients/logins: {time.perf_counter() - t:.1f}s")
+
+    if args.refills:
+        t = time.perf_counter()
+        n = bulk_insert(Refill, refill_rows(clients, pharmacies_by_facility, args.refills))
+        rebuild_rollups(db.session.connection())
+        print(f"{n} refills: {time.perf_counter() - t:.1f}s")
+
+    if args.stock_days:
+        t = time.perf_counter()
+        n = bulk_insert(Stock, stock_rows(pharmacies_by_facility, args.stock_days))
+        rebuild_current_stock(db.session.connection())
+        print(f"{n} stock rows: {time.perf_counter() - t:.1f}s")
 
     db.session.commit()
+    return mapping
+
+def main(argv=None):
+    args = parse_args(argv)
+    with create_app().app_context():
+        mapping = seed(args)
 
     # Print the clear stuffs
     print("✅ Seed complete.")
-    print("--------------------------------------------------")
-    print("Facility short codes (use lowercase as username):")
-    for name, code in mapping:
-        print(f"- {name}  -->  {code}   (login: {code.lower()} / facility123)")
+    if not args.quiet:
+        print("--------------------------------------------------")
+        print("Facility short codes (use lowercase as username):")
+        for name, code in mapping:
+            print(f"- {name}  -->  {code}   (login: {code.lower()} / facility123)")
     print("Admin login: admin / admin123")
+
+#run the code cause we can
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Stock bookkeeping.
+
+``current_stock`` holds the latest ``Stock`` row for every pharmacy/drug pair
+so stock reports are a primary-key lookup instead of a max(date) scan over the
+whole history. ``record_stock`` keeps it in step inside the caller's
+transaction; ``python inventory.py`` rebuilds it from scratch.
+"""
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from models import CurrentStock, Stock
+
+_UPSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def record_stock(pharmacy_id, drug, quantity, date):
+    """Add a Stock row and move current_stock forward. Caller commits."""
+    s = Stock(pharmacy_id=pharmacy_id, drug=drug, quantity=quantity, date=date)
+    db.session.add(s)
+    db.session.flush()
+
+    insert = _UPSERT_DIALECTS[db.session.get_bind().dialect.name]
+    table = CurrentStock.__table__
+    stmt = insert(table).values(pharmacy_id=pharmacy_id, drug=drug, stock_id=s.id, quantity=quantity, date=date)
+    # same date counts as newer: the last entry of the day wins
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.pharmacy_id, table.c.drug],
+        set_={'stock_id': stmt.excluded.stock_id, 'quantity': stmt.excluded.quantity, 'date': stmt.excluded.date},
+        where=stmt.excluded.date >= table.c.date,
+    )
+    db.session.execute(stmt)
+    return s
+
+
+def rebuild_current_stock(conn):
+    # one row per pharmacy/drug: newest date, ties broken by the later insert
+    conn.execute(text('DELETE FROM current_stock'))
+    conn.execute(text(
+        'INSERT INTO current_stock (pharmacy_id, drug, stock_id, quantity, date) '
+        'SELECT s.pharmacy_id, s.drug, s.id, s.quantity, s.date '
+        'FROM (SELECT DISTINCT pharmacy_id, drug FROM stock) AS k '
+        'JOIN stock AS s ON s.id = ('
+        '  SELECT s2.id FROM stock AS s2 WHERE s2.pharmacy_id = k.pharmacy_id AND s2.drug = k.drug '
+        '  ORDER BY s2.date DESC, s2.id DESC LIMIT 1)'
+    ))
+
+
+if __name__ == '__main__':
+    from app import create_app
+    app = create_app()
+
+    with app.app_context():
+        with db.engine.begin() as conn:
+            rebuild_current_stock(conn)
+        print(f"✅ current_stock rebuilt: {CurrentStock.query.count()} rows")
@@ -0,0 +1,119 @@
+"""Process lifecycle hooks for the production server (see gunicorn.conf.py).
+
+- ``warm_up``: open a connection per engine and load the reference data and
+  client ID caches before the first request instead of during it. With
+  ``preload_app`` this runs once in the master, and every worker starts with
+  the caches already filled (shared copy-on-write).
+- ``after_fork``: a forked worker must not reuse the parent's pooled
+  connections or its executor threads, which don't survive a fork.
+- ``start_scheduler``: recompute the stock-out forecasts every
+  ``FORECAST_REFRESH_MINUTES`` on a background thread. Every worker starts
+  one, but only the worker holding a file lock in the instance folder does
+  the work; another takes over if that worker goes away.
+- ``shutdown``: let queued report builds, exports and thumbnails finish,
+  then close every connection.
+"""
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+import auth
+import metrics
+import parquet_export
+from client_index import client_ids
+from extensions import db
+from refdata import refdata
+from reports import store as report_store
+
+log = logging.getLogger(__name__)
+
+_scheduler = None
+_scheduler_stop = threading.Event()
+
+
+def _dispose_engines(app, close=True):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
+
+def _stop_pools(app, wait):
+    report_store.shutdown(wait)
+    app.extensions['uploads'].shutdown(wait)
+    parquet_export.shutdown(wait)
+    auth.shutdown(wait)
+
+
+def warm_up(app, keep_connections=True):
+    """Prime connections and caches. Pass keep_connections=False before forking."""
+    started = time.perf_counter()
+    with app.app_context():
+        for engine in db.engines.values():
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))  # runs the connect pragmas too
+        refdata.get()
+        client_ids.load()
+    if not keep_connections:
+        _dispose_engines(app)
+    log.info('warmed up in %.2fs', time.perf_counter() - started)
+
+
+def _scheduler_lock(app):
+    """An open file holding the scheduler lock, or None if another process has it."""
+    try:
+        import fcntl
+    except ImportError:
+        return True  # no flock (windows dev server), single process anyway
+    os.makedirs(app.instance_path, exist_ok=True)
+    f = open(os.path.join(app.instance_path, 'forecast-scheduler.lock'), 'a')
+    try:
+        # released by the OS when this process exits, however it exits
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def _run_scheduler(app, every):
+    lock = None
+    while not _scheduler_stop.is_set():
+        lock = lock or _scheduler_lock(app)
+        if lock:
+            try:
+                import forecast  # pandas, only in the worker that does the work
+                with app.app_context():
+                    n, changed = forecast.refresh_forecasts()
+                log.info('forecasts %s: %d rows', 'refreshed' if changed else 'unchanged', n)
+            except Exception:
+                log.exception('forecast refresh failed')
+        _scheduler_stop.wait(every)
+
+
+def start_scheduler(app):
+    """Start the forecast refresh thread of this process, unless FORECAST_REFRESH_MINUTES is 0."""
+    global _scheduler
+    minutes = app.config['FORECAST_REFRESH_MINUTES']
+    if minutes <= 0 or _scheduler is not None:
+        return
+    _scheduler_stop.clear()
+    _scheduler = threading.Thread(target=_run_scheduler, args=(app, minutes * 60),
+                                  name='forecast-scheduler', daemon=True)
+    _scheduler.start()
+
+
+def after_fork(app):
+    # close=False: the parent still owns those sockets/file handles
+    _dispose_engines(app, close=False)
+    _stop_pools(app, wait=False)
+    metrics.reset()
+
+
+def shutdown(app, wait=True):
+    _scheduler_stop.set()
+    _stop_pools(app, wait)
+    metrics.flush()  # the last numbers of this worker, folded into the totals later
+    _dispose_engines(app)
@@ -0,0 +1,401 @@
+"""Request and SQL instrumentation, exported in Prometheus text format.
+
+``init_app`` times every request, counts the SQL statements and SQL time it
+caused, keeps the slowest statements with their text, and optionally runs a
+sampling profiler on a fraction of requests. Report builds record their own
+durations through ``observe_report_build``.
+
+Each process counts in memory and writes a snapshot to ``METRICS_DIR``
+(``<pid>.json``) every ``METRICS_FLUSH_SECONDS`` and on shutdown. The
+admin-only ``/admin/metrics`` endpoint, whichever gunicorn worker answers it,
+adds up the snapshots of every worker. Snapshots of workers that have exited
+are folded into ``archive.json``, so counters don't drop when ``max_requests``
+recycles a worker. Gauges only come from live workers, labelled by pid.
+
+A route whose queries per request climbs with the data (an N+1) shows up in
+``cparp_request_sql_queries`` and ``cparp_requests_many_queries_total``, and
+is logged with its query count.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+SLOW_QUERIES_KEPT = 50
+FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+ARCHIVE_FILE = 'archive.json'
+
+
+class Metric:
+
+    def __init__(self, name, help, kind):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.values = {}
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+
+    def __init__(self, name, help):
+        super().__init__(name, help, 'counter')
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        return [f'{self.name}{_labels(k)} {_num(v)}' for k, v in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help, 'gauge')
+
+    def set(self, labels=(), value=0):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help, 'histogram')
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)  # buckets, sum, count
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def render(self):
+        lines = []
+        for labels, counts in sorted(self.values.items()):
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_labels(labels + (("le", _num(bound)),))} {n}')
+            lines.append(f'{self.name}_bucket{_labels(labels + (("le", "+Inf"),))} {counts[-1]}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {_num(counts[-2])}')
+            lines.append(f'{self.name}_count{_labels(labels)} {counts[-1]}')
+        return lines
+
+
+def _num(v):
+    return repr(round(v, 6)) if isinstance(v, float) else str(v)
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = Counter('cparp_http_requests_total', 'Requests by route, method and status.')
+        self.latency = Histogram('cparp_http_request_duration_seconds', 'Request wall time by route.', LATENCY_BUCKETS)
+        self.request_queries = Histogram('cparp_request_sql_queries', 'SQL statements per request by route.', QUERY_BUCKETS)
+        self.request_sql_time = Histogram('cparp_request_sql_seconds', 'SQL time per request by route.', LATENCY_BUCKETS)
+        self.many_queries = Counter('cparp_requests_many_queries_total',
+                                    'Requests over the N+1 query threshold, by route.')
+        self.queries = Counter('cparp_sql_queries_total', 'SQL statements executed, in or outside requests.')
+        self.sql_time = Counter('cparp_sql_seconds_total', 'Time spent in SQL statements.')
+        self.slow_total = Counter('cparp_sql_slow_queries_total', 'Statements slower than the slow query threshold.')
+        self.slow = Gauge('cparp_sql_slow_query_seconds', 'Slowest run of each recent slow statement.')
+        self.report_builds = Histogram('cparp_report_build_seconds', 'Report/export file build time by report.',
+                                       LATENCY_BUCKETS)
+        self.uptime = Gauge('cparp_process_uptime_seconds', 'Seconds since this worker started.')
+        self._slow = OrderedDict()  # (statement, route) -> slowest seconds
+
+    def record_slow(self, statement, route, seconds):
+        key = (statement, route)
+        self._slow[key] = max(seconds, self._slow.pop(key, 0))
+        while len(self._slow) > SLOW_QUERIES_KEPT:
+            self._slow.popitem(last=False)
+
+    def _metrics(self):
+        return (self.requests, self.latency, self.request_queries, self.request_sql_time, self.many_queries,
+                self.queries, self.sql_time, self.slow_total, self.slow, self.report_builds, self.uptime)
+
+    def _refresh_gauges(self):
+        self.uptime.values = {(('pid', str(os.getpid())),): time.time() - self.started}
+        self.slow.values = {(('statement', s), ('route', r)): v for (s, r), v in self._slow.items()}
+
+    def values(self):
+        """Every metric's values as JSON-able data, for merge() in another process."""
+        return {m.name: [[[list(pair) for pair in labels], value] for labels, value in m.values.items()]
+                for m in self._metrics()}
+
+    def snapshot(self):
+        with self.lock:
+            self._refresh_gauges()
+            return self.values()
+
+    def merge(self, values, gauges=True):
+        """Add another registry's values() in. Gauges are skipped for exited workers."""
+        for m in self._metrics():
+            for labels, value in values.get(m.name, []):
+                key = tuple(tuple(pair) for pair in labels)
+                if isinstance(m, Gauge):
+                    if gauges:
+                        m.values[key] = max(m.values.get(key, value), value)
+                elif isinstance(m, Histogram):
+                    counts = m.values.setdefault(key, [0] * len(value))
+                    m.values[key] = [a + b for a, b in zip(counts, value)]
+                else:
+                    m.inc(key, value)
+
+    def lines(self):
+        out = []
+        for m in self._metrics():
+            out += m.header() + m.render()
+        return '\n'.join(out) + '\n'
+
+    def render(self):
+        with self.lock:
+            self._refresh_gauges()
+            return self.lines()
+
+
+registry = Registry()
+
+
+def reset():
+    """Start from zero, e.g. in a freshly forked worker."""
+    global registry
+    registry = Registry()
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # exists, owned by someone else
+    return True
+
+
+def flush():
+    """Write this process's snapshot to METRICS_DIR."""
+    path = _config['dir']
+    if path:
+        os.makedirs(path, exist_ok=True)
+        _write_json(os.path.join(path, f'{os.getpid()}.json'), registry.snapshot())
+
+
+def _dir_lock(path):
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    f = open(os.path.join(path, '.lock'), 'a')
+    fcntl.flock(f, fcntl.LOCK_EX)  # released by close()
+    return f
+
+
+def render():
+    """Prometheus text for all workers sharing METRICS_DIR, or this process alone without one."""
+    path = _config['dir']
+    if not path:
+        return registry.render()
+    flush()
+    combined = Registry()
+    lock = _dir_lock(path)
+    try:
+        archive = _read_json(os.path.join(path, ARCHIVE_FILE)) or {}
+        exited = []
+        for name in os.listdir(path):
+            stem = name[:-len('.json')]
+            if not (name.endswith('.json') and stem.isdigit()):
+                continue
+            values = _read_json(os.path.join(path, name))
+            if values is None:
+                continue
+            if _alive(int(stem)):
+                combined.merge(values)
+            else:
+                exited.append((name, values))
+        if exited and lock is not None:
+            folded = Registry()
+            folded.merge(archive, gauges=False)
+            for _, values in exited:
+                folded.merge(values, gauges=False)
+            archive = folded.values()
+            _write_json(os.path.join(path, ARCHIVE_FILE), archive)
+            for name, _ in exited:
+                os.remove(os.path.join(path, name))
+        else:
+            for _, values in exited:
+                combined.merge(values, gauges=False)
+        combined.merge(archive, gauges=False)
+    finally:
+        if lock is not None:
+            lock.close()
+    return combined.lines()
+
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_loop(pid):
+    while os.getpid() == pid:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            log.exception('metrics flush failed')
+
+
+def _ensure_flusher():
+    # per process: a forked worker doesn't inherit the parent's thread
+    global _flusher_pid
+    pid = os.getpid()
+    if not _config['dir'] or _flusher_pid == pid:
+        return
+    with _flusher_lock:
+        if _flusher_pid != pid:
+            _flusher_pid = pid
+            threading.Thread(target=_flush_loop, args=(pid,), name='metrics-flush', daemon=True).start()
+
+_WS = re.compile(r'\s+')
+
+
+def _route():
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule else 'unmatched'
+    return 'background'
+
+
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and 'metrics_sql' in g:
+        g.metrics_sql[0] += 1
+        g.metrics_sql[1] += elapsed
+    slow = elapsed * 1000 >= _config['slow_query_ms']
+    if slow:
+        route, text = _route(), _WS.sub(' ', statement)[:500]
+        log.warning('slow query (%.0f ms) on %s: %s', elapsed * 1000, route, text)
+    with registry.lock:
+        registry.queries.inc()
+        registry.sql_time.inc(value=elapsed)
+        if slow:
+            registry.slow_total.inc()
+            registry.record_slow(text, route, elapsed)
+
+
+def observe_report_build(name, seconds):
+    with registry.lock:
+        registry.report_builds.observe((('report', name),), seconds)
+
+
+_config = {'slow_query_ms': 200, 'n_plus_one': 50, 'profile_rate': 0.0, 'profile_dir': None, 'dir': None}
+_installed = False
+
+
+def init_app(app):
+    global _installed
+    _config.update(
+        slow_query_ms=float(app.config.get('SLOW_QUERY_MS', os.getenv('SLOW_QUERY_MS', 200))),
+        n_plus_one=int(app.config.get('N_PLUS_ONE_QUERIES', os.getenv('N_PLUS_ONE_QUERIES', 50))),
+        profile_rate=float(app.config.get('PROFILE_SAMPLE_RATE', os.getenv('PROFILE_SAMPLE_RATE', 0))),
+        profile_dir=app.config.get('PROFILE_DIR', os.getenv('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))),
+        dir=app.config.get('METRICS_DIR') or None,
+    )
+    if not _installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor)
+        _installed = True
+
+    @app.before_request
+    def _start_request():
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql = [0, 0.0]
+        if _config['profile_rate'] and random.random() < _config['profile_rate']:
+            g.metrics_profiler = cProfile.Profile()
+            g.metrics_profiler.enable()
+
+    @app.after_request
+    def _remember_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # teardown runs after a streamed body is done, so streaming exports are timed in full
+    @app.teardown_request
+    def _finish_request(exc):
+        if 'metrics_start' not in g:
+            return
+        elapsed = time.perf_counter() - g.metrics_start
+        route = _route()
+        # a status was sent if after_request ran, even if a streamed body failed later
+        status = g.get('metrics_status', 500)
+        queries, sql_seconds = g.metrics_sql
+        labels = (('route', route),)
+        with registry.lock:
+            registry.requests.inc((('route', route), ('method', request.method), ('status', str(status))))
+            registry.latency.observe(labels, elapsed)
+            registry.request_queries.observe(labels, queries)
+            registry.request_sql_time.observe(labels, sql_seconds)
+            if queries > _config['n_plus_one']:
+                registry.many_queries.inc(labels)
+        if queries > _config['n_plus_one']:
+            log.warning('%s ran %d queries in one request, N+1?', route, queries)
+        _ensure_flusher()
+
+        profiler = g.pop('metrics_profiler', None)
+        if profiler:
+            profiler.disable()
+            os.makedirs(_config['profile_dir'], exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{os.getpid()}.prof"
+            profiler.dump_stats(os.path.join(_config['profile_dir'], name))
@@ -0,0 +1,150 @@
+"""Versioned schema migrations.
+
+Run ``python migrations.py`` to bring the configured database up to date.
+Every migration runs in its own transaction and is recorded in the
+``schema_migrations`` table, so it is safe to run against a live database
+and to run more than once. Fresh databases get the same schema from
+``db.create_all()``; the migrations then only stamp themselves as applied.
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+
+def _sql(*statements):
+    def run(conn):
+        for stmt in statements:
+            conn.execute(text(stmt))
+    return run
+
+
+def _add_refill_upload_filename(conn):
+    # older databases were made before the column was on the model
+    cols = {c['name'] for c in inspect(conn).get_columns('refill')}
+    if 'upload_filename' not in cols:
+        conn.execute(text('ALTER TABLE refill ADD COLUMN upload_filename VARCHAR(255)'))
+
+
+def _create_current_stock(conn):
+    from inventory import rebuild_current_stock
+    from models import CurrentStock
+
+    CurrentStock.__table__.create(conn, checkfirst=True)
+    rebuild_current_stock(conn)
+
+
+def _create_stock_forecast(conn):
+    from models import StockForecast
+
+    # filled by the next scheduled forecast.refresh_forecasts
+    StockForecast.__table__.create(conn, checkfirst=True)
+
+
+def _create_refill_rollups(conn):
+    from models import RefillArchive, RefillMonthly
+    from rollups import rebuild_rollups
+
+    RefillMonthly.__table__.create(conn, checkfirst=True)
+    RefillArchive.__table__.create(conn, checkfirst=True)
+    rebuild_rollups(conn)
+
+
+def _create_app_meta(conn):
+    from models import AppMeta
+
+    AppMeta.__table__.create(conn, checkfirst=True)
+
+
+def _create_sync_receipt(conn):
+    from models import SyncReceipt
+
+    SyncReceipt.__table__.create(conn, checkfirst=True)
+
+
+def _create_login_failure(conn):
+    from models import LoginFailure
+
+    LoginFailure.__table__.create(conn, checkfirst=True)
+
+
+# (version, description, fn(conn)) - append only, never edit an applied one
+MIGRATIONS = [
+    (1, 'refill.upload_filename column', _add_refill_upload_filename),
+    (2, 'indexes for report and dashboard queries', _sql(
+        'CREATE INDEX IF NOT EXISTS ix_refill_client_id ON refill (client_id, refill_date)',
+        'CREATE INDEX IF NOT EXISTS ix_refill_pharmacy_id ON refill (pharmacy_id, refill_date)',
+        'CREATE INDEX IF NOT EXISTS ix_client_facility_id ON client (facility_id)',
+        'CREATE INDEX IF NOT EXISTS ix_client_pharmacy_id ON client (pharmacy_id)',
+        'CREATE INDEX IF NOT EXISTS ix_pharmacy_facility_id ON pharmacy (facility_id)',
+        'CREATE INDEX IF NOT EXISTS ix_stock_pharmacy_drug_date ON stock (pharmacy_id, drug, date)',
+    )),
+    (3, 'current_stock table', _create_current_stock),
+    (4, 'client list keyset indexes', _sql(
+        'CREATE INDEX IF NOT EXISTS ix_client_facility_unique_id ON client (facility_id, unique_id)',
+        'CREATE INDEX IF NOT EXISTS ix_client_facility_pharmacy ON client (facility_id, pharmacy_id, unique_id)',
+        # covered by ix_client_facility_unique_id now
+        'DROP INDEX IF EXISTS ix_client_facility_id',
+    )),
+    (5, 'stock_forecast table', _create_stock_forecast),
+    (6, 'refill_monthly rollups and refill_archive', _create_refill_rollups),
+    (7, 'app_meta table', _create_app_meta),
+    (8, 'sync_receipt table', _create_sync_receipt),
+    (9, 'login_failure table', _create_login_failure),
+    (10, 'seed app_meta refdata_version', _sql(
+        "INSERT INTO app_meta (key, value) SELECT 'refdata_version', 0 "
+        "WHERE NOT EXISTS (SELECT 1 FROM app_meta WHERE key = 'refdata_version')",
+    )),
+]
+
+
+def _ensure_version_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER PRIMARY KEY, description VARCHAR(255) NOT NULL, applied_at DATETIME NOT NULL)'
+        ))
+
+
+def applied_versions(engine):
+    _ensure_version_table(engine)
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def current_version(engine):
+    return max(applied_versions(engine), default=0)
+
+
+def upgrade(engine, target=None):
+    """Apply pending migrations up to ``target`` (default: all). Returns the versions applied."""
+    done = applied_versions(engine)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if version in done or (target is not None and version > target):
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            conn.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)'),
+                {'v': version, 'd': description, 't': datetime.utcnow()},
+            )
+        applied.append(version)
+    return applied
+
+
+def main():
+    from app import create_app
+    app = create_app()
+    from extensions import db
+
+    with app.app_context():
+        db.create_all()
+        applied = upgrade(db.engine)
+        for version, description, _ in MIGRATIONS:
+            if version in applied:
+                print(f"✅ {version:04d} {description}")
+        print(f"Schema at version {current_version(db.engine)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 from datetime import datetime
 from extensions import db
 
+DRUGS = ('TDF-3TC-DTG', 'ABC-3TC-DTG')
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -22,6 +24,10 @@ class Facility(db.Model):
 
 
 class Pharmacy(db.Model):
+    __table_args__ = (
+        db.Index('ix_pharmacy_facility_id', 'facility_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
     facility_id = db.Column(db.Integer, db.ForeignKey('facility.id'), nullable=False)
@@ -33,6 +39,13 @@ class Pharmacy(db.Model):
 
 
 class Client(db.Model):
+    __table_args__ = (
+        # client list pages are keyset-paginated by unique_id within a facility
+        db.Index('ix_client_facility_unique_id', 'facility_id', 'unique_id'),
+        db.Index('ix_client_facility_pharmacy', 'facility_id', 'pharmacy_id', 'unique_id'),
+        db.Index('ix_client_pharmacy_id', 'pharmacy_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150))  # pharmacy never sees this
     unique_id = db.Column(db.String(20), unique=True, nullable=False)
@@ -44,6 +57,11 @@ class Client(db.Model):
     refills = db.relationship("Refill", backref="client", lazy=True)   
 
 class Refill(db.Model):
+    __table_args__ = (
+        db.Index('ix_refill_client_id', 'client_id', 'refill_date'),
+        db.Index('ix_refill_pharmacy_id', 'pharmacy_id', 'refill_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     drug = db.Column(db.String(50), nullable=False)  # TDF-3TC-DTG or ABC-3TC-DTG
@@ -54,8 +72,88 @@ class Refill(db.Model):
 
 
 class Stock(db.Model):
+    __table_args__ = (
+        db.Index('ix_stock_pharmacy_drug_date', 'pharmacy_id', 'drug', 'date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     pharmacy_id = db.Column(db.Integer, db.ForeignKey('pharmacy.id'), nullable=False)
     drug = db.Column(db.String(50), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     date = db.Column(db.Date, nullable=False, default=datetime.utcnow)
+
+
+class CurrentStock(db.Model):
+    # latest Stock row per pharmacy/drug, kept in step by inventory.record_stock
+    pharmacy_id = db.Column(db.Integer, db.ForeignKey('pharmacy.id'), primary_key=True)
+    drug = db.Column(db.String(50), primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+
+
+class StockForecast(db.Model):
+    # days-to-stock-out per pharmacy/drug, recomputed in batch by forecast.py
+    pharmacy_id = db.Column(db.Integer, db.ForeignKey('pharmacy.id'), primary_key=True)
+    drug = db.Column(db.String(50), primary_key=True)
+    computed_at = db.Column(db.DateTime, nullable=False)
+    as_of = db.Column(db.Date, nullable=False)
+    stock_quantity = db.Column(db.Integer)  # last count, None if never counted
+    stock_date = db.Column(db.Date)
+    dispensed_since = db.Column(db.Integer, nullable=False, default=0)
+    on_hand = db.Column(db.Integer)
+    rate_7 = db.Column(db.Float, nullable=False, default=0)
+    rate_28 = db.Column(db.Float, nullable=False, default=0)
+    rate_90 = db.Column(db.Float, nullable=False, default=0)
+    daily_rate = db.Column(db.Float, nullable=False, default=0)
+    days_left = db.Column(db.Float)
+    stockout_date = db.Column(db.Date)
+    status = db.Column(db.String(20), nullable=False)
+
+
+class RefillMonthly(db.Model):
+    # refill counts per month, kept in step by rollups.record_refills; covers archived refills too
+    facility_id = db.Column(db.Integer, db.ForeignKey('facility.id'), primary_key=True)  # the client's facility
+    pharmacy_id = db.Column(db.Integer, db.ForeignKey('pharmacy.id'), primary_key=True)
+    drug = db.Column(db.String(50), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)  # first day of the month
+    refills = db.Column(db.Integer, nullable=False, default=0)
+
+
+class RefillArchive(db.Model):
+    # refills moved out of the hot table by rollups.archive_refills, same ids
+    __table_args__ = (
+        db.Index('ix_refill_archive_client_id', 'client_id', 'refill_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    drug = db.Column(db.String(50), nullable=False)
+    refill_date = db.Column(db.Date, nullable=False)
+    pharmacy_id = db.Column(db.Integer, db.ForeignKey('pharmacy.id'), nullable=False)
+    upload_filename = db.Column(db.String(255), nullable=True)
+
+
+class SyncReceipt(db.Model):
+    # one row per record a pharmacy's offline queue has synced, keyed by the client's idempotency key
+    __table_args__ = (
+        db.Index('ix_sync_receipt_received_at', 'received_at'),
+    )
+
+    pharmacy_id = db.Column(db.Integer, db.ForeignKey('pharmacy.id'), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # refill or stock
+    received_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class LoginFailure(db.Model):
+    # failed logins per username, shared by every worker (see auth.LoginThrottle)
+    username = db.Column(db.String(80), primary_key=True)
+    failures = db.Column(db.Integer, nullable=False, default=0)
+    first_failed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class AppMeta(db.Model):
+    # small shared counters, e.g. the reference data version every worker polls
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
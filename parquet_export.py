@@ -0,0 +1,349 @@
+"""Bulk Parquet export for analysts.
+
+Writes clients, refills and stock as zstd-compressed Parquet, partitioned by
+facility in hive layout, plus small facility and pharmacy lookup tables:
+
+    <root>/refills/facility_id=12/20261018T020000123Z.parquet
+    <root>/facilities.parquet
+
+so ``pandas.read_parquet('<root>/refills')`` or any Arrow/Spark/DuckDB
+reader picks the whole set up with ``facility_id`` as a column. Rows are
+read in batches straight into Arrow arrays, never as ORM objects.
+
+Exports are incremental: ``_state.json`` keeps the highest id written for
+each table, and the next run only writes newer rows as new part files. These
+tables are append-only, so ids are a complete cursor. ``--full`` starts over
+and also takes in refills already moved to ``refill_archive``.
+
+One export runs at a time per root, across every worker process and the
+CLI: ``<root>.lock`` is created with O_EXCL before the cursors are read, and
+touched as the export goes so a dead run's lock goes stale.
+
+    python parquet_export.py            # nightly, new rows only
+    python parquet_export.py --full
+
+Needs pyarrow (``pip install pyarrow``); without it the export is
+unavailable and the rest of the app is unaffected.
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import String, func, literal, select, type_coerce, union_all
+
+from database import read_session
+from models import Client, Facility, Pharmacy, Refill, RefillArchive, Stock
+
+BATCH_SIZE = 50000
+COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'zstd')
+STATE_FILE = '_state.json'
+RUNS_KEPT = 100
+# a lock untouched for this long belongs to a killed export
+STALE_LOCK_SECONDS = 30 * 60
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ExportUnavailable(Exception):
+    """pyarrow is not installed."""
+
+
+class ExportRunning(Exception):
+    """Another export holds the lock for this root."""
+
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportUnavailable('Parquet export needs pyarrow: pip install pyarrow') from None
+    return pa, pq
+
+
+def _schemas(pa):
+    return {
+        'clients': pa.schema([('id', pa.int64()), ('unique_id', pa.string()), ('name', pa.string()),
+                              ('pharmacy_id', pa.int64())]),
+        'refills': pa.schema([('id', pa.int64()), ('client_id', pa.int64()), ('unique_id', pa.string()),
+                              ('drug', pa.string()), ('refill_date', pa.date32()), ('pharmacy_id', pa.int64()),
+                              ('archived', pa.bool_())]),
+        'stock': pa.schema([('id', pa.int64()), ('pharmacy_id', pa.int64()), ('drug', pa.string()),
+                            ('quantity', pa.int64()), ('date', pa.date32())]),
+    }
+
+
+def _refills(facility_id, after, upto, full):
+    def part(model, archived):
+        return select(model.id, model.client_id, Client.unique_id, model.drug,
+                      type_coerce(model.refill_date, String), model.pharmacy_id, literal(archived))\
+            .join(Client, Client.id==model.client_id)\
+            .where(Client.facility_id==facility_id, model.id > after, model.id <= upto)
+    hot = part(Refill, False)
+    if not full:
+        return hot.order_by(Refill.id)
+    both = union_all(hot, part(RefillArchive, True)).subquery()
+    return select(both).order_by(both.c[0])
+
+
+def _clients(facility_id, after, upto, full):
+    return select(Client.id, Client.unique_id, Client.name, Client.pharmacy_id)\
+        .where(Client.facility_id==facility_id, Client.id > after, Client.id <= upto).order_by(Client.id)
+
+
+def _stock(facility_id, after, upto, full):
+    return select(Stock.id, Stock.pharmacy_id, Stock.drug, Stock.quantity, type_coerce(Stock.date, String))\
+        .join(Pharmacy, Pharmacy.id==Stock.pharmacy_id)\
+        .where(Pharmacy.facility_id==facility_id, Stock.id > after, Stock.id <= upto).order_by(Stock.id)
+
+
+# dataset -> (id column for the cursor, query for one facility's slice)
+DATASETS = {
+    'clients': (Client.id, _clients),
+    'refills': (Refill.id, _refills),
+    'stock': (Stock.id, _stock),
+}
+
+
+def _max_id(conn, name):
+    ids = [conn.execute(select(func.max(DATASETS[name][0]))).scalar() or 0]
+    if name == 'refills':
+        # archived refills keep their ids, which are always older than the hot ones
+        ids.append(conn.execute(select(func.max(RefillArchive.id))).scalar() or 0)
+    return max(ids)
+
+
+def _batch_table(pa, schema, rows):
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_date(field.type):
+            # ISO strings (sqlite) or dates (postgres); arrow parses the strings itself
+            arr = pa.array(values)
+            arrays.append(arr.cast(field.type) if pa.types.is_string(arr.type) else pa.array(values, field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _write_partition(pa, pq, conn, stmt, schema, path):
+    """Stream one query into one Parquet file. Returns the row count, 0 means no file."""
+    writer, count = None, 0
+    result = conn.execution_options(yield_per=BATCH_SIZE).execute(stmt)
+    try:
+        for rows in result.partitions():
+            if writer is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writer = pq.ParquetWriter(path + '.part', schema, compression=COMPRESSION)
+            writer.write_table(_batch_table(pa, schema, rows))  # one row group per batch
+            count += len(rows)
+    finally:
+        result.close()
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(path + '.part', path)
+    return count
+
+
+def _write_lookups(pa, pq, conn, root):
+    for name, stmt, schema in (
+        ('facilities', select(Facility.id, Facility.name, Facility.shortname),
+         pa.schema([('id', pa.int64()), ('name', pa.string()), ('shortname', pa.string())])),
+        ('pharmacies', select(Pharmacy.id, Pharmacy.name, Pharmacy.facility_id),
+         pa.schema([('id', pa.int64()), ('name', pa.string()), ('facility_id', pa.int64())])),
+    ):
+        rows = conn.execute(stmt.order_by(stmt.selected_columns[0])).all()
+        table = _batch_table(pa, schema, rows) if rows else schema.empty_table()
+        pq.write_table(table, os.path.join(root, f'{name}.parquet.part'), compression=COMPRESSION)
+        os.replace(os.path.join(root, f'{name}.parquet.part'), os.path.join(root, f'{name}.parquet'))
+
+
+def load_state(root):
+    try:
+        with open(os.path.join(root, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'cursors': {}, 'runs': []}
+
+
+def _save_state(root, state):
+    tmp = os.path.join(root, STATE_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, os.path.join(root, STATE_FILE))
+
+
+def _lock_path(root):
+    return root.rstrip('/\\') + '.lock'
+
+
+def _lock_age(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _acquire(root):
+    path = _lock_path(root)
+    age = _lock_age(path)
+    if age is not None and age > STALE_LOCK_SECONDS:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        # O_EXCL: one export per root, whichever process asks first
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        raise ExportRunning(f'an export into {root} is already running') from None
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return path
+
+
+def export(root, full=False):
+    """Write everything newer than the last export under ``root``. Returns the run record.
+
+    A full export is built next to ``root`` and swapped in when complete.
+    Needs an app context. Raises ExportRunning if another export has the root.
+    """
+    pa, pq = _arrow()
+    schemas = _schemas(pa)
+    lock = _acquire(root)
+    try:
+        target = root + '.full-tmp' if full else root
+        if full:
+            shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target, exist_ok=True)
+        state = {'cursors': {}, 'runs': []} if full else load_state(root)
+
+        started = datetime.utcnow()
+        run_id = started.strftime('%Y%m%dT%H%M%S') + f'{started.microsecond // 1000:03d}Z'
+        run = {'id': run_id, 'mode': 'full' if full else 'incremental', 'started': started.isoformat() + 'Z',
+               'rows': {}, 'files': []}
+        conn = read_session.connection()
+        facility_ids = conn.execute(select(Facility.id).order_by(Facility.id)).scalars().all()
+        for name, (_, query) in DATASETS.items():
+            after = state['cursors'].get(name, 0)
+            upto = _max_id(conn, name)  # rows added while we run go to the next export
+            run['rows'][name] = 0
+            if upto > after:
+                for facility_id in facility_ids:
+                    rel = os.path.join(name, f'facility_id={facility_id}', f'{run_id}.parquet')
+                    n = _write_partition(pa, pq, conn, query(facility_id, after, upto, full), schemas[name],
+                                         os.path.join(target, rel))
+                    if n:
+                        run['rows'][name] += n
+                        run['files'].append(rel)
+                    os.utime(lock)  # still alive
+            state['cursors'][name] = max(after, upto)
+        _write_lookups(pa, pq, conn, target)
+
+        run['finished'] = datetime.utcnow().isoformat() + 'Z'
+        state['runs'] = (state['runs'] + [run])[-RUNS_KEPT:]
+        _save_state(target, state)
+        if full:
+            old = root + '.old'
+            shutil.rmtree(old, ignore_errors=True)
+            if os.path.exists(root):
+                os.replace(root, old)
+            os.replace(target, root)
+            shutil.rmtree(old, ignore_errors=True)
+        return run
+    finally:
+        os.remove(lock)
+
+
+def running(root):
+    age = _lock_age(_lock_path(root))
+    return age is not None and age <= STALE_LOCK_SECONDS
+
+
+def submit(app, root, full=False):
+    """Run an export on a background thread. False if one is already running."""
+    global _pool
+    _arrow()  # fail here, not in the background
+    if running(root):
+        return False
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='parquet-export')
+    _pool.submit(_run, app, root, full)
+    return True
+
+
+def shutdown(wait=True):
+    """Stop the export thread; with wait, a running export finishes first."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+def _run(app, root, full):
+    with app.app_context():
+        try:
+            export(root, full)
+        except ExportRunning as e:
+            app.logger.info('parquet export skipped: %s', e)
+        except Exception:
+            app.logger.exception('parquet export failed')
+
+
+def write_zip(root, fileobj, since=None):
+    """Zip the export, or only the part files from runs after ``since``, into fileobj."""
+    state = load_state(root)
+    runs = state['runs']
+    if since:
+        ids = [r['id'] for r in runs]
+        runs = runs[ids.index(since) + 1:] if since in ids else runs
+    files = [f for r in runs for f in r['files']] if since else _all_parts(root)
+    # parquet is compressed already, so just store
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_STORED) as zf:
+        for rel in files + ['facilities.parquet', 'pharmacies.parquet', STATE_FILE]:
+            path = os.path.join(root, rel)
+            if os.path.exists(path):
+                zf.write(path, rel)
+
+
+def _all_parts(root):
+    parts = []
+    for name in DATASETS:
+        for dirpath, _, filenames in os.walk(os.path.join(root, name)):
+            parts += [os.path.relpath(os.path.join(dirpath, f), root) for f in filenames if f.endswith('.parquet')]
+    return sorted(parts)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Export clients, refills and stock as Parquet.')
+    ap.add_argument('--full', action='store_true', help='start over instead of exporting new rows only')
+    ap.add_argument('--out', help='export directory (default PARQUET_EXPORT_DIR)')
+    args = ap.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+
+    with app.app_context():
+        root = args.out or app.config['PARQUET_EXPORT_DIR']
+        try:
+            run = export(root, full=args.full)
+        except ExportRunning as e:
+            raise SystemExit(f'❌ {e}') from None
+    rows = ', '.join(f'{n} {name}' for name, n in run['rows'].items())
+    print(f"✅ {run['mode']} export {run['id']} to {root}: {rows}")
+
+
+if __name__ == '__main__':
+    main()
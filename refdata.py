@@ -0,0 +1,113 @@
+"""Facility and pharmacy reference data, cached per process.
+
+Facilities and pharmacies change a few times a year but fill every dropdown
+and dashboard header. Each worker keeps one copy, tagged with the
+``refdata_version`` counter in ``app_meta``. Adding a facility or pharmacy
+bumps the counter in the same transaction. Other workers notice within
+``CHECK_SECONDS``; the worker that made the change sees it at once.
+
+The same data is served as JSON at a versioned URL, so browsers can cache
+it for good and only refetch when the version changes. That version is a hash
+of the data itself, not the counter: the counter starts over on a fresh or
+reset database, and an old URL must never come back with new contents.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from models import AppMeta, Facility, Pharmacy
+
+VERSION_KEY = 'refdata_version'
+CHECK_SECONDS = float(os.getenv('REFDATA_CHECK_SECONDS', 5))
+
+_UPSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+FacilityRef = namedtuple('FacilityRef', 'id name shortname')
+PharmacyRef = namedtuple('PharmacyRef', 'id name facility_id')
+
+
+class RefData:
+    """One immutable snapshot of the reference tables."""
+
+    def __init__(self, counter, facilities, pharmacies):
+        self.counter = counter  # app_meta value this was loaded at
+        self.facilities = facilities  # sorted by name
+        self.pharmacies = pharmacies
+        self.facility_by_id = {f.id: f for f in facilities}
+        self.pharmacy_by_id = {p.id: p for p in pharmacies}
+        self._data = {
+            'facilities': [f._asdict() for f in facilities],
+            'pharmacies': [p._asdict() for p in pharmacies],
+        }
+        content = json.dumps(self._data, separators=(',', ':'), sort_keys=True)
+        self.version = hashlib.sha1(content.encode()).hexdigest()[:16]
+        self._json = None
+
+    def pharmacies_for(self, facility_id):
+        """id -> pharmacy for one facility, in name order."""
+        return {p.id: p for p in self.pharmacies if p.facility_id == facility_id}
+
+    def json(self):
+        # serialized once per version, not per request
+        if self._json is None:
+            self._json = json.dumps({'version': self.version, **self._data}, separators=(',', ':'))
+        return self._json
+
+
+def stored_version():
+    return db.session.query(AppMeta.value).filter_by(key=VERSION_KEY).scalar() or 0
+
+
+def bump_version():
+    """Mark the reference data changed. Runs in the caller's transaction; call
+    ``refdata.invalidate()`` after the commit."""
+    table = AppMeta.__table__
+    insert_ = _UPSERT_DIALECTS[db.session.get_bind().dialect.name]
+    # migration 10 seeds the row; the upsert covers a reset database without racing on the key
+    stmt = insert_(table).values(key=VERSION_KEY, value=1)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=[table.c.key],
+                                                  set_={'value': table.c.value + 1}))
+
+
+def load():
+    counter = stored_version()
+    facilities = [FacilityRef(*row) for row in
+                  db.session.query(Facility.id, Facility.name, Facility.shortname).order_by(Facility.name)]
+    pharmacies = [PharmacyRef(*row) for row in
+                  db.session.query(Pharmacy.id, Pharmacy.name, Pharmacy.facility_id).order_by(Pharmacy.name)]
+    return RefData(counter, facilities, pharmacies)
+
+
+class RefDataCache:
+
+    def __init__(self, check_seconds=CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self._data = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """The current snapshot. Costs one tiny query every ``check_seconds`` at most."""
+        data, now = self._data, time.monotonic()
+        if data is not None and now - self._checked < self.check_seconds:
+            return data
+        with self._lock:
+            if self._data is not None and now - self._checked < self.check_seconds:
+                return self._data
+            if self._data is None or stored_version() != self._data.counter:
+                self._data = load()
+            self._checked = time.monotonic()
+            return self._data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+
+refdata = RefDataCache()
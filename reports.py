@@ -0,0 +1,494 @@
+"""Report engine, registry and background builds.
+
+Every downloadable report is registered here with the role that may run it,
+a builder that yields its sheets, and a cheap data-version query for its
+scope (the user's facility, pharmacy, or everything for admins). Finished
+files are cached on disk keyed by report, scope and data version, so
+identical requests share one build and repeat downloads are a sendfile.
+
+Workbooks are written with openpyxl's write-only mode from batched queries,
+so memory stays flat whatever the row count.
+
+Background jobs are tracked with marker files next to the artifacts rather
+than in process memory, so any worker can answer a status poll.
+
+openpyxl and the pandas analytics (adherence, forecast) are imported the
+first time a report needs them, not when the app starts: workers and CLIs
+that never build a report don't pay for them.
+"""
+import csv
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+
+from flask import current_app, session
+
+from database import read_session
+from extensions import db
+from metrics import observe_report_build
+from models import Facility, Pharmacy, Client, Refill, CurrentStock, StockForecast, RefillMonthly
+
+log = logging.getLogger(__name__)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+CSV_MIMETYPE = 'text/csv'
+
+# rows pulled from the db per round trip
+BATCH_SIZE = 1000
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', 2))
+# a build marker older than this is assumed dead (worker killed mid-build)
+STALE_BUILD_SECONDS = 30 * 60
+# a replaced version stays this long, for requests that already picked its path
+OLD_VERSION_GRACE_SECONDS = 10 * 60
+
+
+def query_sheet(title, columns, query):
+    """A (title, columns, rows) sheet that reads the query in batches."""
+    return title, columns, query.yield_per(BATCH_SIZE)
+
+
+def write_xlsx(fileobj, sheets):
+    from openpyxl import Workbook
+
+    # write-only mode streams each row to disk instead of keeping a cell tree around
+    wb = Workbook(write_only=True)
+    for title, columns, rows in sheets:
+        ws = wb.create_sheet(title=title)
+        ws.append(columns)
+        for row in rows:
+            ws.append(list(row))
+    wb.save(fileobj)
+
+
+def write_csv(fileobj, sheets):
+    out = io.TextIOWrapper(fileobj, encoding='utf-8', newline='')
+    writer = csv.writer(out)
+    for _, columns, rows in sheets:
+        writer.writerow(columns)
+        writer.writerows(rows)
+    out.flush()
+    out.detach()
+
+
+WRITERS = {'xlsx': (write_xlsx, XLSX_MIMETYPE), 'csv': (write_csv, CSV_MIMETYPE)}
+
+
+class Report:
+
+    def __init__(self, name, role, download_name, build, version, fmt='xlsx'):
+        self.name = name
+        self.role = role
+        self.download_name = download_name
+        self.build = build
+        self.version = version
+        self.fmt = fmt
+        self.mimetype = WRITERS[fmt][1]
+
+    def write(self, fileobj, scope):
+        WRITERS[self.fmt][0](fileobj, self.build(scope))
+
+
+REPORTS = {}
+
+
+def report(name, role, download_name, version, fmt='xlsx'):
+    """Register ``fn(scope) -> sheets`` as a report."""
+    def decorator(fn):
+        REPORTS[name] = Report(name, role, download_name, fn, version, fmt)
+        return fn
+    return decorator
+
+
+def report_scope(role):
+    """The facility/pharmacy id a role's reports are limited to, None for admin."""
+    return {'facility': session.get('facility_id'), 'pharmacy': session.get('pharmacy_id')}.get(role)
+
+
+# data versions. nothing in the app edits or deletes these rows, so the
+# newest id plus a row count changes whenever the report would.
+
+def _facility_refill_version(facility_id):
+    return read_session.query(db.func.max(Refill.id), db.func.count(Refill.id))\
+        .join(Client, Client.id==Refill.client_id)\
+        .filter(Client.facility_id==facility_id).one()
+
+
+def _pharmacy_refill_version(pharmacy_id):
+    return read_session.query(db.func.max(Refill.id), db.func.count(Refill.id))\
+        .filter(Refill.pharmacy_id==pharmacy_id).one()
+
+
+def _facility_stock_version(facility_id):
+    return read_session.query(db.func.max(CurrentStock.stock_id), db.func.count())\
+        .join(Pharmacy, Pharmacy.id==CurrentStock.pharmacy_id)\
+        .filter(Pharmacy.facility_id==facility_id).one()
+
+
+def _pharmacy_stock_version(pharmacy_id):
+    return read_session.query(db.func.max(CurrentStock.stock_id), db.func.count())\
+        .filter(CurrentStock.pharmacy_id==pharmacy_id).one()
+
+
+def _facility_adherence_version(facility_id):
+    # due dates and lateness move with the calendar, so today is part of it
+    clients = read_session.query(db.func.max(Client.id), db.func.count(Client.id))\
+        .filter(Client.facility_id==facility_id).one()
+    return _facility_refill_version(facility_id), clients, date.today().isoformat()
+
+
+def _monthly_version(facility_id):
+    q = read_session.query(db.func.sum(RefillMonthly.refills), db.func.count())
+    if facility_id is not None:
+        q = q.filter(RefillMonthly.facility_id==facility_id)
+    return q.one()
+
+
+def _forecast_version(_):
+    # forecasts are recomputed on a schedule; their timestamp is the version
+    return read_session.query(db.func.max(StockForecast.computed_at)).one()
+
+
+def _admin_version(_):
+    return tuple(read_session.query(db.func.max(m.id), db.func.count(m.id)).one() for m in (Facility, Pharmacy, Client))
+
+
+# the reports
+
+@report('facility_refills', 'facility', 'facility_refills.xlsx', _facility_refill_version)
+def facility_refills(facility_id):
+    # refill, pharamcy and clients
+    rows = read_session.query(Client.name, Client.unique_id, Refill.drug, Refill.refill_date, Pharmacy.name)\
+        .join(Refill, Refill.client_id==Client.id)\
+        .join(Pharmacy, Pharmacy.id==Refill.pharmacy_id)\
+        .filter(Client.facility_id==facility_id)
+    return [query_sheet('Refills', ['Client Name','Unique ID','Drug','Refill Date','Pharmacy'], rows)]
+
+
+@report('facility_stock', 'facility', 'facility_stocks.xlsx', _facility_stock_version)
+def facility_stock(facility_id):
+    # latest level per pharmacy/drug comes straight from current_stock
+    rows = read_session.query(Pharmacy.name, CurrentStock.drug, CurrentStock.quantity, CurrentStock.date)\
+        .join(Pharmacy, Pharmacy.id==CurrentStock.pharmacy_id)\
+        .filter(Pharmacy.facility_id==facility_id)\
+        .order_by(Pharmacy.name, CurrentStock.drug)
+    return [query_sheet('Stocks', ['Pharmacy','Drug','Quantity','Date'], rows)]
+
+
+@report('pharmacy_refills', 'pharmacy', 'pharmacy_refills.xlsx', _pharmacy_refill_version)
+def pharmacy_refills(pharmacy_id):
+    rows = read_session.query(Client.unique_id, Refill.drug, Refill.refill_date)\
+        .join(Refill, Refill.client_id==Client.id)\
+        .filter(Refill.pharmacy_id==pharmacy_id)
+    return [query_sheet('Refills', ['Unique ID','Drug','Refill Date'], rows)]
+
+
+@report('pharmacy_stock', 'pharmacy', 'pharmacy_stocks.xlsx', _pharmacy_stock_version)
+def pharmacy_stock(pharmacy_id):
+    rows = read_session.query(CurrentStock.drug, CurrentStock.quantity, CurrentStock.date)\
+        .filter(CurrentStock.pharmacy_id==pharmacy_id)\
+        .order_by(CurrentStock.drug)
+    return [query_sheet('Stocks', ['Drug','Quantity','Date'], rows)]
+
+
+def _frame_rows(df, columns):
+    # NaN/NaT to empty cells, numpy scalars to plain python for the writers
+    df = df[columns].astype(object)
+    return df.where(df.notna(), None).itertuples(index=False, name=None)
+
+
+@report('facility_adherence', 'facility', 'facility_adherence.xlsx', _facility_adherence_version)
+def facility_adherence(facility_id):
+    import adherence
+
+    clients, pharmacies, overall = adherence.facility_adherence(facility_id)
+    counts = ['Clients', 'On Time', 'Late', 'Defaulted', 'No Refills',
+              'Median PDC', f'PDC >= {adherence.PDC_TARGET:.0%} (%)', 'Mean Days Between Refills']
+    summary_cols = ['clients', *adherence.STATUSES, 'median_pdc', 'pdc_on_target', 'mean_interval']
+    return [
+        ('Clients', ['Unique ID', 'Client Name', 'Pharmacy', 'Status', 'Days Overdue', 'Supply Due',
+                     'Refills', 'First Refill', 'Last Refill', 'Mean Days Between Refills',
+                     'Late Refills', 'Most Days Late', 'PDC'],
+         _frame_rows(clients, ['unique_id', 'name', 'pharmacy', 'status', 'days_overdue', 'due',
+                               'refills', 'first_refill', 'last_refill', 'mean_interval',
+                               'late_refills', 'max_days_late', 'pdc'])),
+        ('Pharmacies', ['Pharmacy', *counts], _frame_rows(pharmacies.reset_index(), ['pharmacy', *summary_cols])),
+        ('Facility', counts, _frame_rows(overall, summary_cols)),
+    ]
+
+
+# monthly totals come from the rollups, so they cover archived refills and never scan refill
+
+@report('facility_monthly', 'facility', 'facility_refills_monthly.xlsx', _monthly_version)
+def facility_monthly(facility_id):
+    M = RefillMonthly
+    rows = read_session.query(M.month, Pharmacy.name, M.drug, M.refills)\
+        .join(Pharmacy, Pharmacy.id==M.pharmacy_id)\
+        .filter(M.facility_id==facility_id)\
+        .order_by(M.month.desc(), Pharmacy.name, M.drug)
+    return [query_sheet('Monthly Refills', ['Month', 'Pharmacy', 'Drug', 'Refills'], rows)]
+
+
+@report('admin_monthly', 'admin', 'refills_monthly.xlsx', _monthly_version)
+def admin_monthly(_):
+    M = RefillMonthly
+    rows = read_session.query(M.month, Facility.name, Pharmacy.name, M.drug, M.refills)\
+        .join(Facility, Facility.id==M.facility_id)\
+        .join(Pharmacy, Pharmacy.id==M.pharmacy_id)\
+        .order_by(M.month.desc(), Facility.name, Pharmacy.name, M.drug)
+    return [query_sheet('Monthly Refills', ['Month', 'Facility', 'Pharmacy', 'Drug', 'Refills'], rows)]
+
+
+FORECAST_COLUMNS = ['Drug', 'Status', 'On Hand', 'Days Left', 'Stock-out Date', 'Units/Day',
+                    '7-day Rate', '28-day Rate', '90-day Rate', 'Last Count', 'Count Date', 'Dispensed Since Count']
+
+
+def _forecast_rows(*leading):
+    F = StockForecast
+    return read_session.query(*leading, F.drug, F.status, F.on_hand, db.func.round(F.days_left, 1), F.stockout_date,
+                              db.func.round(F.daily_rate, 2), db.func.round(F.rate_7, 2), db.func.round(F.rate_28, 2),
+                              db.func.round(F.rate_90, 2), F.stock_quantity, F.stock_date, F.dispensed_since)\
+        .join(Pharmacy, Pharmacy.id==F.pharmacy_id)\
+        .order_by(F.days_left.is_(None), F.days_left, Pharmacy.name, F.drug)
+
+
+@report('facility_forecast', 'facility', 'facility_stockout_forecast.xlsx', _forecast_version)
+def facility_forecast(facility_id):
+    rows = _forecast_rows(Pharmacy.name).filter(Pharmacy.facility_id==facility_id)
+    return [query_sheet('Stock-out Forecast', ['Pharmacy', *FORECAST_COLUMNS], rows)]
+
+
+@report('admin_forecast', 'admin', 'stockout_forecast.xlsx', _forecast_version)
+def admin_forecast(_):
+    rows = _forecast_rows(Facility.name, Pharmacy.name).join(Facility, Facility.id==Pharmacy.facility_id)
+    return [query_sheet('Stock-out Forecast', ['Facility', 'Pharmacy', *FORECAST_COLUMNS], rows)]
+
+
+def _admin_pharmacies():
+    return read_session.query(Pharmacy.id, Pharmacy.name, Facility.name)\
+        .outerjoin(Facility, Facility.id==Pharmacy.facility_id).order_by(Pharmacy.id)
+
+
+def _admin_clients():
+    return read_session.query(Client.id, Client.unique_id, Client.name, Facility.name, Pharmacy.name)\
+        .outerjoin(Facility, Facility.id==Client.facility_id)\
+        .outerjoin(Pharmacy, Pharmacy.id==Client.pharmacy_id).order_by(Client.id)
+
+
+@report('admin_report', 'admin', 'admin_report.xlsx', _admin_version)
+def admin_report(_):
+    return [
+        query_sheet('Facilities', ['ID','Name','Shortname'],
+                    read_session.query(Facility.id, Facility.name, Facility.shortname).order_by(Facility.id)),
+        query_sheet('Pharmacies', ['ID','Name','Facility'], _admin_pharmacies()),
+        query_sheet('Clients', ['ID','Unique ID','Name','Facility','Pharmacy'], _admin_clients()),
+    ]
+
+
+def admin_csv_rows():
+    """Facility, pharmacy and client rows of the admin CSV, read in batches."""
+    for f_id, f_name in read_session.query(Facility.id, Facility.name).order_by(Facility.id).yield_per(BATCH_SIZE):
+        yield ["Facility", f_id, f_name, "-", "-"]
+    for p_id, p_name, fac_name in _admin_pharmacies().yield_per(BATCH_SIZE):
+        yield ["Pharmacy", p_id, p_name, fac_name or "-", "-"]
+    for c_id, unique_id, _, fac_name, pharm_name in _admin_clients().yield_per(BATCH_SIZE):
+        yield ["Client", c_id, unique_id, fac_name or "-", pharm_name or "N/A"]
+
+
+ADMIN_CSV_COLUMNS = ["Type", "ID", "Name/Unique ID", "Facility", "Pharmacy"]
+
+
+@report('admin_csv', 'admin', 'admin_report.csv', _admin_version, fmt='csv')
+def admin_csv(_):
+    return [('admin', ADMIN_CSV_COLUMNS, admin_csv_rows())]
+
+
+# artifacts and jobs
+
+_JOB_ID_RE = re.compile(r'^(?P<name>[a-z_]+)-(?P<scope>\d+|all)-(?P<version>[0-9a-f]{16})$')
+
+
+def job_id(report, scope, version):
+    digest = hashlib.sha1(repr(tuple(version)).encode()).hexdigest()[:16]
+    return f"{report.name}-{'all' if scope is None else scope}-{digest}"
+
+
+def parse_job_id(value):
+    """(report, scope) for a job id, or None if it is not one of ours."""
+    m = _JOB_ID_RE.match(value or '')
+    if not m or m['name'] not in REPORTS:
+        return None
+    return REPORTS[m['name']], None if m['scope'] == 'all' else int(m['scope'])
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ReportStore:
+    """Report files on disk plus the background pool that builds them."""
+
+    def __init__(self, root=None, workers=REPORT_WORKERS):
+        self._root = root
+        self.workers = workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._key_locks = {}  # key -> [lock, threads using it]
+        self._key_locks_lock = threading.Lock()
+
+    @property
+    def root(self):
+        root = self._root or current_app.config['REPORT_CACHE_DIR']
+        os.makedirs(root, exist_ok=True)
+        return root
+
+    def path(self, report, key):
+        return os.path.join(self.root, f'{key}.{report.fmt}')
+
+    def _marker(self, key, kind):
+        return os.path.join(self.root, f'{key}.{kind}')
+
+    @contextmanager
+    def _locked(self, key):
+        with self._key_locks_lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._key_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def cached(self, report, key):
+        path = self.path(report, key)
+        return path if os.path.exists(path) else None
+
+    @contextmanager
+    def open_artifact(self, report, key):
+        """A temp file that becomes the artifact for key if the block finishes, and is dropped if not."""
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'w+b') as out:
+                yield out
+            os.replace(tmp, self.path(report, key))
+        except BaseException:
+            _remove(tmp)
+            raise
+        self._sweep()
+
+    def build(self, report, scope, key):
+        """Build the artifact for key unless it exists, on this thread. Use submit() from requests."""
+        with self._locked(key):
+            path = self.path(report, key)
+            if os.path.exists(path):
+                return path
+            started = time.perf_counter()
+            with self.open_artifact(report, key) as out:
+                report.write(out, scope)
+            elapsed = time.perf_counter() - started
+            observe_report_build(report.name, elapsed)
+            log.info('built %s in %.2fs', key, elapsed)
+            return path
+
+    def _sweep(self):
+        """Remove versions replaced more than the grace period ago, and .part files of dead builds."""
+        now = time.time()
+        versions = {}  # report-scope -> {key: (newest mtime, paths)}
+        for entry in os.scandir(self.root):
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.name.endswith('.part'):
+                if now - mtime > STALE_BUILD_SECONDS:
+                    _remove(entry.path)
+                continue
+            key = entry.name.split('.', 1)[0]
+            if '-' not in key:
+                continue
+            by_key = versions.setdefault(key.rsplit('-', 1)[0], {})
+            newest, paths = by_key.get(key, (0, []))
+            by_key[key] = (max(newest, mtime), paths + [entry.path])
+        for by_key in versions.values():
+            ordered = sorted(by_key.values())
+            # each version was replaced when the next one appeared
+            for (_, paths), (replaced_at, _) in zip(ordered, ordered[1:]):
+                if now - replaced_at > OLD_VERSION_GRACE_SECONDS:
+                    for path in paths:
+                        _remove(path)
+
+    def status(self, report, key):
+        if self.cached(report, key):
+            return 'done'
+        error = self._marker(key, 'error')
+        if os.path.exists(error):
+            return 'failed'
+        pending = self._marker(key, 'pending')
+        if os.path.exists(pending) and time.time() - os.path.getmtime(pending) < STALE_BUILD_SECONDS:
+            return 'running'
+        return None
+
+    def error(self, key):
+        try:
+            with open(self._marker(key, 'error')) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def submit(self, report, scope, key):
+        """Queue a build for key unless it is done or already being built. Returns the status."""
+        status = self.status(report, key)
+        if status in ('done', 'running'):
+            return status
+        pending = self._marker(key, 'pending')
+        for marker in (pending, self._marker(key, 'error')):
+            if os.path.exists(marker):
+                os.remove(marker)
+        try:
+            # O_EXCL: only one worker process gets to start the build
+            os.close(os.open(pending, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return 'running'
+        app = current_app._get_current_object()
+        self._executor().submit(self._run, app, report, scope, key)
+        return 'running'
+
+    def _run(self, app, report, scope, key):
+        with app.app_context():
+            try:
+                self.build(report, scope, key)
+            except Exception as e:
+                log.exception('report build %s failed', key)
+                with open(self._marker(key, 'error'), 'w') as f:
+                    f.write(str(e) or e.__class__.__name__)
+            finally:
+                _remove(self._marker(key, 'pending'))
+
+    def _executor(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='report')
+        return self._pool
+
+    def shutdown(self, wait=True):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+
+store = ReportStore()
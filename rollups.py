@@ -0,0 +1,202 @@
+"""Monthly refill rollups and archival of old refills.
+
+``refill_monthly`` holds refill counts per (facility, pharmacy, drug, month).
+Every code path that inserts refills calls ``record_refills`` in the same
+transaction, so history and totals come from a few thousand rollup rows
+instead of a scan over every refill ever made.
+
+Refills older than ``ARCHIVE_MONTHS`` can then be moved out of the hot
+``refill`` table, either into ``refill_archive`` or to a gzipped CSV file.
+The rollups keep counting them either way.
+
+    python rollups.py rebuild
+    python rollups.py archive --months 24 [--file refills-2023.csv.gz]
+"""
+import argparse
+import csv
+import gzip
+import io
+import os
+import zlib
+from collections import Counter
+from datetime import date
+
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from models import Refill, RefillArchive, RefillMonthly
+
+ARCHIVE_MONTHS = int(os.getenv('REFILL_ARCHIVE_MONTHS', 24))
+ARCHIVE_BATCH = 10000
+
+_UPSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+# first day of the refill's month, per dialect
+_MONTH_SQL = {
+    'sqlite': "date(refill_date, 'start of month')",
+    'postgresql': "CAST(date_trunc('month', refill_date) AS DATE)",
+}
+
+
+def month_start(d):
+    return d.replace(day=1)
+
+
+def months_ago(months, today=None):
+    """First day of the month ``months`` before today's month."""
+    today = today or date.today()
+    total = today.year * 12 + today.month - 1 - months
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def record_refills(rows):
+    """Count (facility_id, pharmacy_id, drug, refill_date) rows into the rollups. Caller commits."""
+    counts = Counter((f, p, drug, month_start(d)) for f, p, drug, d in rows)
+    if not counts:
+        return
+    insert_ = _UPSERT_DIALECTS[db.session.get_bind().dialect.name]
+    table = RefillMonthly.__table__
+    stmt = insert_(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.facility_id, table.c.pharmacy_id, table.c.drug, table.c.month],
+        set_={'refills': table.c.refills + stmt.excluded.refills},
+    )
+    db.session.execute(stmt, [
+        {'facility_id': f, 'pharmacy_id': p, 'drug': drug, 'month': month, 'refills': n}
+        for (f, p, drug, month), n in counts.items()
+    ])
+
+
+def rebuild_rollups(conn):
+    """Recount refill_monthly from refill and refill_archive.
+
+    Months older than anything left in those tables were archived to files;
+    their rollup rows are kept as they are.
+    """
+    month = _MONTH_SQL[conn.dialect.name]
+    first = conn.execute(text(
+        'SELECT min(m) FROM (SELECT min(refill_date) AS m FROM refill '
+        'UNION ALL SELECT min(refill_date) FROM refill_archive) AS t'
+    )).scalar()
+    if first is None:
+        return
+    first = month_start(first if isinstance(first, date) else date.fromisoformat(first))
+    conn.execute(delete(RefillMonthly.__table__).where(RefillMonthly.month >= first))
+    conn.execute(text(
+        'INSERT INTO refill_monthly (facility_id, pharmacy_id, drug, month, refills) '
+        f'SELECT c.facility_id, r.pharmacy_id, r.drug, {month} AS month, count(*) '
+        'FROM (SELECT client_id, pharmacy_id, drug, refill_date FROM refill '
+        '      UNION ALL SELECT client_id, pharmacy_id, drug, refill_date FROM refill_archive) AS r '
+        'JOIN client AS c ON c.id = r.client_id '
+        'GROUP BY c.facility_id, r.pharmacy_id, r.drug, month'
+    ))
+
+
+def pharmacy_refill_count(pharmacy_id):
+    return db.session.query(func.coalesce(func.sum(RefillMonthly.refills), 0))\
+        .filter(RefillMonthly.pharmacy_id==pharmacy_id).scalar()
+
+
+ARCHIVE_COLUMNS = ['id', 'client_id', 'drug', 'refill_date', 'pharmacy_id', 'upload_filename']
+
+
+def _archive_tail(path):
+    """(highest id in the file, bytes of complete gzip members) of an archive file.
+
+    Each batch is its own gzip member, so a batch cut off by a crash is an
+    unfinished member at the end and is not counted.
+    """
+    max_id = good = offset = 0
+    inflater, member = zlib.decompressobj(16 + zlib.MAX_WBITS), []
+    with open(path, 'rb') as f:
+        chunk = f.read(1 << 20)
+        while chunk:
+            member.append(inflater.decompress(chunk))
+            if not inflater.eof:
+                offset += len(chunk)
+                chunk = f.read(1 << 20)
+                continue
+            offset += len(chunk) - len(inflater.unused_data)
+            good = offset
+            for row in csv.reader(io.StringIO(b''.join(member).decode('utf-8'))):
+                if row and row[0].isdigit():
+                    max_id = max(max_id, int(row[0]))
+            chunk = inflater.unused_data or f.read(1 << 20)
+            inflater, member = zlib.decompressobj(16 + zlib.MAX_WBITS), []
+    return max_id, good
+
+
+def _append_batch(path, rows, header):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(ARCHIVE_COLUMNS)
+    writer.writerows(rows)
+    with open(path, 'ab') as f:
+        f.write(gzip.compress(buf.getvalue().encode('utf-8')))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def archive_refills(before, path=None):
+    """Move refills dated before ``before`` out of the hot table. Returns how many moved.
+
+    They go to refill_archive, or appended to the gzipped CSV at ``path``.
+    Each batch is its own short transaction so pharmacy writes keep flowing.
+    A file batch is on disk (fsynced) before its rows are deleted, and a
+    re-run skips ids the file already has, so a crash at any point neither
+    loses nor repeats refills. Keep ``before`` on the first of a month, so
+    ``rebuild_rollups`` never sees half of a month that went to a file.
+    """
+    columns = [getattr(Refill, c) for c in ARCHIVE_COLUMNS]
+    last_id, size = 0, 0
+    if path and os.path.exists(path):
+        last_id, size = _archive_tail(path)
+        if os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)  # half-written batch from a crash; its rows are still in the table
+    moved = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(select(*columns).where(Refill.refill_date < before)
+                                .order_by(Refill.id).limit(ARCHIVE_BATCH)).all()
+            if not rows:
+                break
+            if path:
+                new = [r for r in rows if r[0] > last_id]
+                if new:
+                    _append_batch(path, new, header=not size)
+                    last_id, size = new[-1][0], size or 1
+            else:
+                conn.execute(insert(RefillArchive.__table__), [dict(zip(ARCHIVE_COLUMNS, r)) for r in rows])
+            conn.execute(delete(Refill.__table__).where(Refill.id.in_([r[0] for r in rows])))
+        moved += len(rows)
+    return moved
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Refill rollups and archival.')
+    sub = ap.add_subparsers(dest='command', required=True)
+    sub.add_parser('rebuild', help='recount refill_monthly from the refill tables')
+    arc = sub.add_parser('archive', help='move old refills out of the refill table')
+    arc.add_argument('--months', type=int, default=ARCHIVE_MONTHS,
+                     help=f'keep this many months plus the current one (default {ARCHIVE_MONTHS})')
+    arc.add_argument('--file', help='append to this .csv.gz instead of the refill_archive table')
+    args = ap.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+
+    with app.app_context():
+        if args.command == 'rebuild':
+            with db.engine.begin() as conn:
+                rebuild_rollups(conn)
+            print(f"✅ refill_monthly rebuilt: {RefillMonthly.query.count()} rows")
+        else:
+            before = months_ago(args.months)
+            moved = archive_refills(before, args.file)
+            print(f"✅ archived {moved} refills from before {before} to {args.file or 'refill_archive'}")
+
+
+if __name__ == '__main__':
+    main()
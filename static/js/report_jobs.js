@@ -0,0 +1,42 @@
+// Report buttons with data-report-job build in the background: submit the
+// job, poll its status, then download the finished file. Without JS the
+// plain href queues the same job and lands on a self-refreshing wait page.
+(function () {
+  function poll(btn, label, statusUrl) {
+    fetch(statusUrl, {credentials: 'same-origin'})
+      .then(function (r) { return r.json(); })
+      .then(function (job) { handle(btn, label, job); })
+      .catch(function () { done(btn, label, 'Failed, try again'); });
+  }
+
+  function handle(btn, label, job) {
+    if (job.status === 'done') {
+      done(btn, label);
+      window.location = job.download_url;
+    } else if (job.status === 'failed') {
+      done(btn, label, 'Failed, try again');
+    } else {
+      setTimeout(function () { poll(btn, label, job.status_url); }, 1000);
+    }
+  }
+
+  function done(btn, label, message) {
+    btn.classList.remove('busy');
+    btn.textContent = message || label;
+    if (message) setTimeout(function () { btn.textContent = label; }, 4000);
+  }
+
+  document.addEventListener('click', function (e) {
+    var btn = e.target.closest('[data-report-job]');
+    if (!btn) return;
+    e.preventDefault();
+    if (btn.classList.contains('busy')) return;
+    var label = btn.textContent;
+    btn.classList.add('busy');
+    btn.textContent = 'Preparing…';
+    fetch(btn.getAttribute('data-report-job'), {method: 'POST', credentials: 'same-origin'})
+      .then(function (r) { return r.json(); })
+      .then(function (job) { handle(btn, label, job); })
+      .catch(function () { done(btn, label, 'Failed, try again'); });
+  });
+})();
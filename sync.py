@@ -0,0 +1,214 @@
+"""Batched offline sync for pharmacies with poor connectivity.
+
+The pharmacy's device queues refills and stock counts while offline and
+posts them in one (optionally gzipped) JSON batch:
+
+    POST /pharmacy/sync
+    Content-Encoding: gzip
+    {"refills": [{"key": "3f1c...", "unique_id": "SAHE0042", "drug": "TDF-3TC-DTG", "date": "2026-10-01"}],
+     "stock": [{"key": "9a0e...", "drug": "TDF-3TC-DTG", "quantity": 240, "date": "2026-10-01"}],
+     "clients_since": 0}
+
+Every record carries a key the device generated (a UUID). Keys are
+remembered in ``sync_receipt``, in the same transaction as the records, so
+a retried batch never inserts anything twice. The whole batch is one
+transaction: refills go in with one executemany plus ``record_refills``,
+stock through ``record_stock``.
+
+The response counts what was applied and what was already there, and lists
+rejected records with the reason. Every key that is not rejected is stored
+and can be dropped from the queue. With ``clients_since`` it also returns the
+unique IDs of the pharmacy's clients added after that cursor. Clients are
+never reassigned or deleted, so their id is a complete cursor.
+
+    python sync.py prune [--days 180]   # forget old receipts
+"""
+import argparse
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from ingest import validate_refill, validate_stock, resolve_clients, insert_refills
+from inventory import record_stock
+from models import Client, SyncReceipt
+from rollups import record_refills
+
+# limits apply to the decompressed body
+MAX_BODY_BYTES = int(os.getenv('SYNC_MAX_BODY_MB', 16)) * 1024 * 1024
+MAX_RECORDS = int(os.getenv('SYNC_MAX_RECORDS', 5000))
+CLIENT_PAGE = int(os.getenv('SYNC_CLIENT_PAGE', 5000))
+# a device that comes back after longer than this may resend old records
+RECEIPT_DAYS = int(os.getenv('SYNC_RECEIPT_DAYS', 180))
+MAX_KEY_LENGTH = 64
+LOOKUP_CHUNK = 500
+
+
+class SyncError(ValueError):
+    """A batch that can't be read at all. Nothing was applied."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_body(data, content_encoding=None):
+    """The JSON payload of a request body, gunzipping it if needed."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            raw = inflater.decompress(data, MAX_BODY_BYTES)
+        except zlib.error:
+            raise SyncError('Body is not valid gzip') from None
+        if inflater.unconsumed_tail:
+            raise SyncError(f'Body is over {MAX_BODY_BYTES // (1024 * 1024)} MB uncompressed', 413)
+        if not inflater.eof:
+            raise SyncError('Body is truncated')
+        data = raw
+    elif encoding != 'identity':
+        raise SyncError(f"Unsupported Content-Encoding '{content_encoding}'", 415)
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        raise SyncError('Body is not valid JSON') from None
+    if not isinstance(payload, dict):
+        raise SyncError('Body must be a JSON object')
+    return payload
+
+
+def read_batch(payload):
+    """(refills, stock, clients_since) from a decoded payload."""
+    refills, stock = payload.get('refills') or [], payload.get('stock') or []
+    if not isinstance(refills, list) or not isinstance(stock, list):
+        raise SyncError('refills and stock must be lists')
+    if len(refills) + len(stock) > MAX_RECORDS:
+        raise SyncError(f'Too many records, the limit is {MAX_RECORDS} per batch', 413)
+    since = payload.get('clients_since')
+    if since is not None and (isinstance(since, bool) or not isinstance(since, int) or since < 0):
+        raise SyncError('clients_since must be a non-negative integer')
+    return refills, stock, since
+
+
+def _key(row):
+    key = row.get('key') if isinstance(row, dict) else None
+    return key if isinstance(key, str) and 0 < len(key) <= MAX_KEY_LENGTH else None
+
+
+def _received(pharmacy_id, keys):
+    keys = list(keys)
+    found = set()
+    for i in range(0, len(keys), LOOKUP_CHUNK):
+        found.update(k for (k,) in db.session.query(SyncReceipt.key)
+                     .filter(SyncReceipt.pharmacy_id==pharmacy_id, SyncReceipt.key.in_(keys[i:i + LOOKUP_CHUNK])))
+    return found
+
+
+def _apply(pharmacy_id, refills, stock):
+    entries = [('refill', row) for row in refills] + [('stock', row) for row in stock]
+    seen = _received(pharmacy_id, {k for k in map(_key, (row for _, row in entries)) if k})
+    result = {'refills': {'applied': 0, 'duplicates': 0}, 'stock': {'applied': 0, 'duplicates': 0}, 'rejected': []}
+    counts = {'refill': result['refills'], 'stock': result['stock']}
+
+    def reject(kind, key, error):
+        result['rejected'].append({'kind': kind, 'key': key, 'error': error})
+
+    new_refills, new_stock = [], []
+    for kind, row in entries:
+        key = _key(row)
+        if key is None:
+            reject(kind, row.get('key') if isinstance(row, dict) else None,
+                   f'Missing key, or longer than {MAX_KEY_LENGTH} characters')
+        elif key in seen:
+            counts[kind]['duplicates'] += 1  # applied by an earlier try, or twice in this batch
+        elif kind == 'refill':
+            seen.add(key)
+            unique_id, drug, refill_date, error = validate_refill(row)
+            if error:
+                reject(kind, key, error)
+            else:
+                new_refills.append((key, unique_id, drug, refill_date))
+        else:
+            seen.add(key)
+            drug, quantity, day, error = validate_stock(row)
+            if error:
+                reject(kind, key, error)
+            else:
+                new_stock.append((key, drug, quantity, day))
+
+    clients = resolve_clients(uid for _, uid, _, _ in new_refills)
+    values, rollup, receipts = [], [], []
+    now = datetime.utcnow()
+    for key, unique_id, drug, refill_date in new_refills:
+        if unique_id not in clients:
+            reject('refill', key, 'Client not found')
+            continue
+        client_id, facility_id = clients[unique_id]
+        values.append({'client_id': client_id, 'drug': drug, 'refill_date': refill_date, 'pharmacy_id': pharmacy_id})
+        rollup.append((facility_id, pharmacy_id, drug, refill_date))
+        receipts.append({'pharmacy_id': pharmacy_id, 'key': key, 'kind': 'refill', 'received_at': now})
+    insert_refills(values)
+    record_refills(rollup)
+    # oldest first, so current_stock ends on the newest count
+    for key, drug, quantity, day in sorted(new_stock, key=lambda s: s[3]):
+        record_stock(pharmacy_id, drug, quantity, day)
+        receipts.append({'pharmacy_id': pharmacy_id, 'key': key, 'kind': 'stock', 'received_at': now})
+    if receipts:
+        db.session.execute(insert(SyncReceipt.__table__), receipts)
+    db.session.commit()
+    result['refills']['applied'] = len(values)
+    result['stock']['applied'] = len(new_stock)
+    return result
+
+
+def apply_batch(pharmacy_id, refills, stock):
+    """Apply a batch in one transaction. Returns what was applied, skipped and rejected."""
+    try:
+        return _apply(pharmacy_id, refills, stock)
+    except IntegrityError:
+        # the same batch racing itself on another worker; its receipts are committed now
+        db.session.rollback()
+        return _apply(pharmacy_id, refills, stock)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def client_delta(pharmacy_id, since):
+    """Unique IDs of the pharmacy's clients with an id above ``since``, a page at a time."""
+    rows = db.session.query(Client.id, Client.unique_id)\
+        .filter(Client.pharmacy_id==pharmacy_id, Client.id > since)\
+        .order_by(Client.id).limit(CLIENT_PAGE + 1).all()
+    more = len(rows) > CLIENT_PAGE
+    rows = rows[:CLIENT_PAGE]
+    return {'unique_ids': [uid for _, uid in rows], 'cursor': rows[-1][0] if rows else since, 'more': more}
+
+
+def prune_receipts(days=RECEIPT_DAYS):
+    """Forget receipts older than ``days``. Returns how many went."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    with db.engine.begin() as conn:
+        return conn.execute(delete(SyncReceipt.__table__).where(SyncReceipt.received_at < cutoff)).rowcount
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Offline sync housekeeping.')
+    sub = ap.add_subparsers(dest='command', required=True)
+    prune = sub.add_parser('prune', help='forget old idempotency receipts')
+    prune.add_argument('--days', type=int, default=RECEIPT_DAYS, help=f'keep this many days (default {RECEIPT_DAYS})')
+    args = ap.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+
+    with app.app_context():
+        n = prune_receipts(args.days)
+        print(f"✅ pruned {n} sync receipts older than {args.days} days")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Content-addressed store for prescription uploads.
+
+Files are streamed to disk in chunks while being hashed and stored as
+``<sha256[:2]>/<sha256>.<ext>`` under the upload folder, so two pharmacies
+uploading ``scan.jpg`` never collide and the same scan uploaded twice is
+kept once. Thumbnails are made on a small background pool; if Pillow is
+not installed they are simply skipped and thumbnail requests get a 404.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+THUMB_SIZE = (320, 320)
+THUMB_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+
+_KEY_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$')
+_EXT_ALIASES = {'jpeg': 'jpg'}
+
+
+class UploadStore:
+
+    def __init__(self, root):
+        self.root = root
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def path(self, key):
+        if not _KEY_RE.match(key or ''):
+            raise ValueError(f'bad upload key {key!r}')
+        return os.path.join(self.root, key)
+
+    def thumb_path(self, key):
+        self.path(key)
+        return os.path.join(self.root, 'thumbs', key.rsplit('.', 1)[0] + '.jpg')
+
+    def save(self, file):
+        """Stream a werkzeug FileStorage into the store and return its key."""
+        ext = file.filename.rsplit('.', 1)[1].lower()
+        ext = _EXT_ALIASES.get(ext, ext)
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+            h = digest.hexdigest()
+            key = f'{h[:2]}/{h}.{ext}'
+            dest = self.path(key)
+            if os.path.exists(dest):
+                os.remove(tmp)
+                return key
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self._executor().submit(self._make_thumbnail, key)
+        return key
+
+    def _executor(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix='thumbnail')
+        return self._pool
+
+    def shutdown(self, wait=True):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def _make_thumbnail(self, key):
+        try:
+            from PIL import Image
+        except ImportError:
+            return
+        dest = self.thumb_path(key)
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with Image.open(self.path(key)) as im:
+                im.draft('RGB', THUMB_SIZE)  # lets jpeg decode at a reduced scale
+                im = im.convert('RGB')
+                im.thumbnail(THUMB_SIZE)
+                tmp = dest + '.tmp'
+                im.save(tmp, 'JPEG', quality=80, optimize=True)
+            os.replace(tmp, dest)
+        except Exception:
+            log.exception('thumbnail failed for %s', key)
@@ -1,12 +1,23 @@
 from functools import wraps
-from flask import session, redirect, url_for
+from flask import session, redirect, url_for, jsonify
 
 def role_required(*roles):
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
             if "role" not in session or session.get("role") not in roles:
-                return redirect(url_for("login"))
+                return redirect(url_for("main.login"))
             return fn(*args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def api_role_required(*roles):
+    """role_required for JSON endpoints: 401 JSON instead of a redirect to the login page."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if session.get("role") not in roles:
+                return jsonify(error="Not logged in as " + " or ".join(roles)), 401
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator